@@ -0,0 +1,209 @@
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from analysis.segmentation import Segmenter
+from analysis.tiles import SceneCache
+from utils.color_detection import MIN_AREA, detect_colors, largest_per_color
+from utils.detectors import Detector, as_detector, fit_clusters
+from utils.frame_context import FrameContext
+from utils.helpers import calculate_accuracy
+from utils.ordering import assign_to_targets, grid_order, row_order
+from utils.palettes import Palette
+from utils.slots import score_slots
+
+
+class Request(NamedTuple):
+    """
+    One analysis job. background and snapshot are frames in play-area
+    coordinates, detector a Palette or Detector, target the expected color
+    order and slots None or an (n, 4) array of (x0, y0, x1, y1). layout is
+    "row", "grid", "slots" (score the pixels of each slot) or "match"
+    (assign blocks to the nearest slot); clusters fits colors from the
+    snapshot instead.
+    """
+    background: Union[np.ndarray, FrameContext]
+    snapshot: Union[np.ndarray, FrameContext]
+    detector: Union[Palette, Detector]
+    target: List[str]
+    slots: Optional[np.ndarray] = None
+    layout: str = "row"
+    clusters: bool = False
+
+
+class Analysis(NamedTuple):
+    """
+    Outcome of one job. placed holds (position, color, (x, y)) of every
+    block that was found, image is the annotated BGR snapshot and timings
+    maps each stage name to seconds. mask is the segmenter's buffer, valid
+    until the pipeline's next run. reason says why the run stopped early
+    (nothing was placed), or is None when every stage ran.
+    """
+    mask: np.ndarray
+    detector: Union[Palette, Detector]
+    detected_order: List[Optional[str]]
+    placed: List[Tuple[int, str, Tuple[float, float]]]
+    correct: int
+    wrong: int
+    missing: int
+    accuracy: float
+    image: np.ndarray
+    timings: Dict[str, float]
+    reason: Optional[str] = None
+
+
+def slot_centers(slots):
+    return np.stack([slots[:, [0, 2]].mean(axis=1), slots[:, [1, 3]].mean(axis=1)], axis=1)
+
+
+class AnalysisPipeline:
+    """
+    Snapshot analysis without any UI: foreground mask, detector choice,
+    detection and ordering, scoring and annotation. Every stage is a plain
+    method that can be called on its own; run() chains them and records
+    how long each one took. Masks are computed into reusable buffers, so
+    a pipeline should not be shared between threads.
+
+    With incremental set the pipeline remembers the previous snapshot and
+    only re-segments and re-classifies the tiles that changed since.
+    threads (default: one per core) splits classification into bands run
+    on the shared thread pool.
+    """
+
+    STAGES = ("mask", "check", "detector", "labels", "order", "score", "annotate")
+
+    def __init__(self, threshold=40, blur=5, min_area=MIN_AREA, incremental=False, threads=None):
+        self.segmenter = Segmenter(threshold, blur)
+        self.scene = SceneCache() if incremental else None
+        self.min_area = min_area
+        self.threads = threads or os.cpu_count() or 1
+
+    def mask(self, request):
+        if self.scene is not None:
+            return self.scene.update_mask(self.segmenter, request.background, request.snapshot)
+        return self.segmenter.foreground(request.background, request.snapshot)
+
+    def check(self, request, mask):
+        """
+        Why there is nothing to analyze, or None. Counting the changed pixels
+        and then the changed regions, on every other row and column with
+        half the area as margin, costs far less than detection.
+        """
+        changed = cv2.countNonZero(mask)
+        if changed < self.min_area:
+            return f"no change from the background ({changed} pixels)"
+
+        sparse = np.ascontiguousarray(mask[::2, ::2])
+        n, _, stats, _ = cv2.connectedComponentsWithStats(sparse, connectivity=8)
+        if n < 2 or stats[1:, cv2.CC_STAT_AREA].max() * 4 < self.min_area // 2:
+            return f"only {n - 1} changed specks, all smaller than {self.min_area} pixels"
+        return None
+
+    def detector(self, request, mask):
+        if request.clusters:
+            clusters = fit_clusters(request.snapshot, mask, k=len(request.target) + 2)
+            if clusters is not None:
+                return clusters
+        return request.detector
+
+    def labels(self, request, detector, mask):
+        """
+        Full-frame label image kept up to date tile by tile, or None when
+        the pipeline is not incremental (detection then labels only the
+        regions it needs).
+        """
+        if self.scene is None:
+            return None
+        return self.scene.update_labels(
+            request.snapshot, as_detector(detector), self.min_area, self.threads
+        )
+
+    def order(self, request, detector, mask, labels=None):
+        """
+        -> (detected_order, placed)
+        """
+        frame, slots = request.snapshot, request.slots
+
+        if request.layout == "slots" and slots is not None:
+            detected_order = score_slots(frame, slots, detector, mask, labels=labels)
+            centers = slot_centers(slots)
+            placed = [(i, c, centers[i]) for i, c in enumerate(detected_order) if c is not None]
+            return detected_order, placed
+
+        if labels is None:
+            detected = detect_colors(frame, detector, self.min_area, mask=mask, threads=self.threads)
+        else:
+            # labels is the scene cache's, which keeps their blobs too
+            detected = largest_per_color(self.scene.update_blobs(len(detector.colors), self.min_area), detector)
+        colors = list(detected)
+        centroids = np.array([detected[c] for c in colors], np.float64).reshape(-1, 2)
+
+        if request.layout == "match" and slots is not None:
+            match = assign_to_targets(
+                centroids, slot_centers(slots), max_distance=float(np.median(slots[:, 2] - slots[:, 0]))
+            )
+            detected_order = [colors[j] if j >= 0 else None for j in match]
+            placed = [(i, colors[j], centroids[j]) for i, j in enumerate(match) if j >= 0]
+            return detected_order, placed
+
+        order = grid_order(centroids) if request.layout == "grid" else row_order(centroids)
+        return [colors[j] for j in order], [(i, colors[j], centroids[j]) for i, j in enumerate(order)]
+
+    def score(self, request, detected_order):
+        """
+        -> (correct, wrong, missing, accuracy)
+        """
+        return calculate_accuracy(detected_order, list(request.target))
+
+    def annotate(self, request, placed):
+        """
+        Snapshot with a box and a tick on every block in its target position.
+        """
+        img = FrameContext.wrap(request.snapshot).bgr.copy()
+        target = request.target
+
+        for i, color, pos in placed:
+            x, y = int(round(pos[0])), int(round(pos[1]))
+            if i < len(target) and color == target[i]:
+                cv2.rectangle(img, (x - 50, y - 50), (x + 50, y + 50), (0, 255, 0), 3)
+                cv2.putText(img, f"{color} ✔", (x - 40, y - 60),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+
+        return img
+
+    def run(self, request):
+        timings = {}
+
+        def timed(stage, *args):
+            start = time.perf_counter()
+            out = getattr(self, stage)(request, *args)
+            timings[stage] = time.perf_counter() - start
+            return out
+
+        request = request._replace(
+            background=FrameContext.wrap(request.background),
+            snapshot=FrameContext.wrap(request.snapshot),
+        )
+        mask = timed("mask")
+        reason = timed("check", mask)
+
+        if reason is not None:
+            correct, wrong, missing, accuracy = timed("score", [])
+            return Analysis(
+                mask, request.detector, [], [], correct, wrong, missing, accuracy,
+                request.snapshot.bgr, timings, reason,
+            )
+
+        detector = timed("detector", mask)
+        labels = timed("labels", detector, mask)
+        detected_order, placed = timed("order", detector, mask, labels)
+        correct, wrong, missing, accuracy = timed("score", detected_order)
+        image = timed("annotate", placed)
+
+        return Analysis(
+            mask, detector, detected_order, placed,
+            correct, wrong, missing, accuracy, image, timings,
+        )
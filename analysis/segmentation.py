@@ -0,0 +1,76 @@
+import cv2
+import numpy as np
+
+from utils.frame_context import FrameContext
+
+
+def foreground_mask(bg, frame, threshold=40, blur=5):
+    """
+    Pixels that changed between the background and the frame.
+    """
+    diff = cv2.absdiff(FrameContext.wrap(bg).bgr, FrameContext.wrap(frame).bgr)
+    gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+    _, mask = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+    return cv2.medianBlur(mask, blur)
+
+
+class Segmenter:
+    """
+    Foreground and motion masks computed into buffers the segmenter owns,
+    one set per frame size, so repeated calls at a resolution allocate
+    nothing. Returned masks are those buffers: copy one to keep it past the
+    next call, and give each thread its own segmenter.
+    """
+
+    def __init__(self, threshold=40, blur=5, motion_threshold=25):
+        self.threshold = threshold
+        self.blur = blur
+        self.motion_threshold = motion_threshold
+        self._buffers = {}
+
+    def buffer(self, name, shape):
+        key = (name, shape)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = np.empty(shape, np.uint8)
+        return buf
+
+    def foreground(self, bg, frame, box=None, dst=None):
+        """
+        Pixels that changed between the background and the frame:
+        absdiff -> gray -> threshold -> median blur, all through dst=.
+
+        With box (x0, y0, x1, y1) only that part is computed, from a margin
+        wide enough for the median blur to match a full-frame pass, and
+        copied into the same part of dst when one is given. Returns dst, or
+        the segmenter's mask buffer.
+        """
+        bg, frame = FrameContext.wrap(bg).bgr, FrameContext.wrap(frame).bgr
+        h, w = size = frame.shape[:2]
+        mask = self.buffer("mask", size)
+
+        x0, y0, x1, y1 = (0, 0, w, h) if box is None else box
+        pad = self.blur // 2
+        px0, py0, px1, py1 = max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, w), min(y1 + pad, h)
+        diff = self.buffer("diff", frame.shape)[py0:py1, px0:px1]
+        gray = self.buffer("gray", size)[py0:py1, px0:px1]
+
+        cv2.absdiff(bg[py0:py1, px0:px1], frame[py0:py1, px0:px1], dst=diff)
+        cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.threshold(gray, self.threshold, 255, cv2.THRESH_BINARY, dst=gray)
+        cv2.medianBlur(gray, self.blur, dst=mask[py0:py1, px0:px1])
+
+        if dst is None:
+            return mask
+        dst[y0:y1, x0:x1] = mask[y0:y1, x0:x1]
+        return dst
+
+    def motion(self, prev_gray, gray):
+        """
+        Number of pixels that changed by more than motion_threshold between
+        two grayscale frames.
+        """
+        diff = self.buffer("motion", gray.shape)
+        cv2.absdiff(prev_gray, gray, dst=diff)
+        cv2.threshold(diff, self.motion_threshold, 255, cv2.THRESH_BINARY, dst=diff)
+        return cv2.countNonZero(diff)
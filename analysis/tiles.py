@@ -0,0 +1,233 @@
+import cv2
+import numpy as np
+
+from utils.color_detection import (
+    Blobs, concat_blobs, find_blobs, get_pool, label_image, mask_regions, merge_boxes, offset_blobs,
+)
+from utils.frame_context import FrameContext
+
+TILE = 32
+
+
+def tile_means(frame, tile=TILE):
+    """
+    (ceil(H / tile), ceil(W / tile), 3) float32 mean color of each tile.
+    Whole tiles go through one integer-factor INTER_AREA resize (the fast
+    path); partial tiles at the right and bottom edges are averaged as
+    strips.
+    """
+    bgr = FrameContext.wrap(frame).bgr
+    h, w = bgr.shape[:2]
+    th, tw = h // tile, w // tile
+    rows, cols = -(-h // tile), -(-w // tile)
+    means = np.empty((rows, cols, 3), np.float32)
+
+    if th and tw:
+        means[:th, :tw] = cv2.resize(bgr[:th * tile, :tw * tile], (tw, th), interpolation=cv2.INTER_AREA)
+    if th and cols > tw:
+        means[:th, tw:] = cv2.resize(bgr[:th * tile, tw * tile:], (1, th), interpolation=cv2.INTER_AREA)
+    if rows > th:
+        means[th:] = cv2.resize(bgr[th * tile:], (cols, 1), interpolation=cv2.INTER_AREA)
+    return means
+
+
+class SceneCache:
+    """
+    The previous snapshot's tile signatures (tile means of the background
+    and the frame), its foreground mask, its label image and its blobs. A
+    new snapshot only re-segments and re-classifies the tiles whose
+    signature moved by more than tolerance, plus a one-tile border around
+    them, and only re-extracts the blobs around those; everything else is
+    reused. The background's tile means are kept for as long as the same
+    background array comes back (backgrounds are never changed in place).
+    """
+
+    def __init__(self, tile=TILE, tolerance=8):
+        self.tile = tile
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        self.shape = None
+        self.background = None
+        self.bg_means = None
+        self.signature = None
+        self.mask = None
+        self.labels = None
+        self.key = None
+        # pixel boxes (x0, y0, x1, y1) whose labels are stale; None means all
+        self.pending = None
+        # pixel boxes reclassified since the blobs were last extracted
+        self.stale = []
+        self.blobs = None
+        self.min_area = None
+        self.changed = 1.0
+
+    def changed_boxes(self, signature):
+        """
+        Pixel boxes covering the changed tiles, grown by one tile.
+        """
+        moved = (np.abs(signature - self.signature) > self.tolerance).any(axis=2)
+        self.signature[moved] = signature[moved]
+        self.changed = float(moved.mean())
+        if not moved.any():
+            return []
+
+        grid = cv2.dilate(moved.view(np.uint8), np.ones((3, 3), np.uint8))
+        _, _, stats, _ = cv2.connectedComponentsWithStats(grid, connectivity=8)
+        h, w = self.shape[:2]
+        t = self.tile
+
+        return [
+            (x * t, y * t, min((x + bw) * t, w), min((y + bh) * t, h))
+            for x, y, bw, bh in stats[1:, :4].tolist()
+        ]
+
+    def update_mask(self, segmenter, bg, frame):
+        """
+        Foreground mask of frame, recomputed by segmenter only inside the
+        changed tiles. The returned array belongs to the cache.
+        """
+        bg, frame = FrameContext.wrap(bg), FrameContext.wrap(frame)
+
+        if self.mask is not None and frame.shape != self.shape:
+            self.reset()
+        if bg.bgr is not self.background:
+            self.background, self.bg_means = bg.bgr, tile_means(bg, self.tile)
+        signature = np.concatenate([self.bg_means, tile_means(frame, self.tile)], axis=2)
+
+        if self.mask is None:
+            self.shape = frame.shape
+            self.signature = signature
+            self.mask = segmenter.foreground(bg, frame).copy()
+            return self.mask
+
+        boxes = self.changed_boxes(signature)
+        for box in boxes:
+            segmenter.foreground(bg, frame, box, self.mask)
+
+        if self.pending is not None:
+            self.pending.extend(boxes)
+        return self.mask
+
+    def update_labels(self, frame, detector, min_area, threads=1):
+        """
+        Label image of frame under detector, reclassifying only the boxes
+        whose mask changed since the last call (everything when the
+        detector changed). With threads > 1 the boxes are split into
+        horizontal bands classified on the shared pool. The returned array
+        belongs to the cache.
+        """
+        frame = FrameContext.wrap(frame)
+
+        if self.labels is None or self.pending is None or self.key != detector.key:
+            self.labels = np.zeros(frame.shape[:2], np.uint8)
+            self.key = detector.key
+            self.blobs = None
+            boxes = mask_regions(self.mask, min_area)
+        else:
+            boxes = self.pending
+
+        bands = []
+        for x0, y0, x1, y1 in boxes:
+            edges = np.linspace(y0, y1, min(threads, y1 - y0) + 1).astype(int).tolist()
+            bands.extend((x0, top, x1, bottom) for top, bottom in zip(edges, edges[1:]))
+
+        def classify(band):
+            x0, y0, x1, y1 = band
+            self.labels[y0:y1, x0:x1] = label_image(frame[y0:y1, x0:x1], detector, self.mask[y0:y1, x0:x1])
+
+        if threads > 1 and len(bands) > 1:
+            list(get_pool(threads).map(classify, bands))
+        else:
+            for band in bands:
+                classify(band)
+
+        self.pending = []
+        self.stale.extend(boxes)
+        return self.labels
+
+    def update_blobs(self, n_labels, min_area):
+        """
+        Blobs of the label image, re-extracted only inside the boxes
+        reclassified since the last call. Each box is grown until it takes
+        in every previous blob it touches and no colored pixel inside it
+        borders one outside, so a component is never cut in two.
+        """
+        labels = self.labels
+        if self.blobs is None or self.min_area != min_area:
+            self.blobs = find_blobs(labels, n_labels, min_area)
+            self.min_area = min_area
+            self.stale = []
+            return self.blobs
+        if not self.stale:
+            return self.blobs
+
+        h, w = labels.shape
+        old = self.blobs
+        ox0, oy0 = old.bbox[:, 0], old.bbox[:, 1]
+        ox1, oy1 = ox0 + old.bbox[:, 2], oy0 + old.bbox[:, 3]
+        keep = np.ones(len(old.label), bool)
+
+        todo = merge_boxes(
+            (max(x0 - 1, 0), max(y0 - 1, 0), min(x1 + 1, w), min(y1 + 1, h))
+            for x0, y0, x1, y1 in self.stale
+        )
+        done = []
+
+        while todo:
+            box = todo.pop()
+            x0, y0, x1, y1 = box
+            grown = None
+
+            hit = keep & (ox0 < x1) & (x0 < ox1) & (oy0 < y1) & (y0 < oy1)
+            if hit.any():
+                keep &= ~hit
+                grown = [
+                    min(x0, int(ox0[hit].min())), min(y0, int(oy0[hit].min())),
+                    max(x1, int(ox1[hit].max())), max(y1, int(oy1[hit].max())),
+                ]
+            else:
+                left, top, right, bottom = _crossed_sides(labels, box)
+                if left or top or right or bottom:
+                    t = self.tile
+                    grown = [
+                        max(x0 - t * left, 0), max(y0 - t * top, 0),
+                        min(x1 + t * right, w), min(y1 + t * bottom, h),
+                    ]
+
+            if grown is not None:
+                # take in the finished boxes the grown one now overlaps
+                todo.extend(b for b, _ in done if _overlap(b, grown))
+                done = [(b, found) for b, found in done if not _overlap(b, grown)]
+                todo = merge_boxes(todo + [grown])
+                continue
+
+            found = find_blobs(labels[y0:y1, x0:x1], n_labels, min_area)
+            done.append((box, offset_blobs(found, x0, y0)))
+
+        self.blobs = concat_blobs([Blobs(*(field[keep] for field in old))] + [found for _, found in done])
+        self.stale = []
+        return self.blobs
+
+
+def _overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _crossed_sides(labels, box):
+    """
+    (left, top, right, bottom) flags: whether colored pixels on that edge
+    of box have colored 8-neighbours just outside it.
+    """
+    h, w = labels.shape
+    x0, y0, x1, y1 = box
+    ey0, ey1 = max(y0 - 1, 0), min(y1 + 1, h)
+    ex0, ex1 = max(x0 - 1, 0), min(x1 + 1, w)
+
+    return (
+        x0 > 0 and labels[y0:y1, x0].any() and labels[ey0:ey1, x0 - 1].any(),
+        y0 > 0 and labels[y0, x0:x1].any() and labels[y0 - 1, ex0:ex1].any(),
+        x1 < w and labels[y0:y1, x1 - 1].any() and labels[ey0:ey1, x1].any(),
+        y1 < h and labels[y1 - 1, x0:x1].any() and labels[y1, ex0:ex1].any(),
+    )
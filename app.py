@@ -5,10 +5,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 from streamlit_webrtc import webrtc_streamer, WebRtcMode
 
+from analysis.pipeline import AnalysisPipeline, Request
+from analysis.segmentation import foreground_mask
 from auth.login import login_ui
 from video.video_processor import VideoProcessor
-from utils.color_detection import detect_colors
-from utils.helpers import calculate_accuracy
+from utils.color_detection import detect_blobs
+from utils.palettes import get_palette, palette_names, default_palette_name
+from utils.calibration import (
+    calibrate, calibrate_backprojection, load_backprojection, load_calibration,
+    load_roi, save_roi,
+)
+from utils.frame_context import FrameContext
+from utils.rectify import clamp_roi, find_markers, homography, parse_quad, parse_roi, rectify
+from utils.slots import even_slots, slots_from_blobs
+from utils.white_balance import balance_lut, gray_world_gains, white_balance
 from reports.pdf_generator import generate_pdf
 
 
@@ -23,6 +33,12 @@ defaults = {
     "current_order": [],
     "snapshot": None,
     "bg_frame": None,
+    "palette": default_palette_name(),
+    "slots": None,
+    "warp": None,
+    "roi": None,
+    "roi_location": None,
+    "wb_lut": None,
 }
 
 for key, value in defaults.items():
@@ -30,7 +46,6 @@ for key, value in defaults.items():
         st.session_state[key] = value
 
 
-COLORS = ["Red", "Blue", "Green"]
 st.set_page_config("Color Puzzle", layout="wide")
 
 
@@ -42,10 +57,26 @@ if not st.session_state.logged_in:
     st.stop()
 
 
+if st.session_state.roi_location != st.session_state.location:
+    st.session_state.roi = load_roi(st.session_state.location)
+    st.session_state.roi_location = st.session_state.location
+    # slots are in play-area coordinates, which the new ROI moves
+    st.session_state.slots = None
+
+
 st.title("🎨 Color Arrangement Puzzle")
 st.info(f"👧 {st.session_state.child_name} | 📍 {st.session_state.location}")
 
-if not st.session_state.current_order:
+st.selectbox("🧩 Puzzle Palette", palette_names(), key="palette")
+backend = st.radio(
+    "🔬 Detector", ["Thresholds", "Back-projection", "Auto clusters (free play)"],
+    horizontal=True, key="backend"
+)
+st.checkbox("⚖️ White-balance against the saved background", value=True, key="white_balance")
+palette = get_palette(st.session_state.palette)
+COLORS = palette.colors
+
+if sorted(st.session_state.current_order) != sorted(COLORS):
     st.session_state.current_order = random.sample(COLORS, len(COLORS))
 
 st.subheader("🎯 Target Color Order")
@@ -62,71 +93,267 @@ ctx = webrtc_streamer(
     media_stream_constraints={"video": True, "audio": False},
 )
 
-
-
-col1, col2 = st.columns(2)
+st.checkbox("🏷️ Track and label blocks on the live view", key="show_tracks")
+st.checkbox("📐 Show live slot colors", key="show_slots")
+
+
+
+# one pipeline per session, so its buffers are reused across reruns
+if "pipeline" not in st.session_state:
+    st.session_state.pipeline = AnalysisPipeline(incremental=True)
+PIPELINE = st.session_state.pipeline
+
+
+def background():
+    """
+    The stream's running background model, or the saved background when
+    the stream has none.
+    """
+    vp = ctx.video_processor
+    model = None if vp is None else vp.background
+    return st.session_state.bg_frame if model is None else model
+
+
+def play_area(img):
+    """
+    img rectified to the play area once a perspective warp has been set,
+    otherwise cropped to the play-area rectangle if there is one.
+    """
+    warp, roi = st.session_state.warp, st.session_state.roi
+    if img is None:
+        return img
+    if warp is not None:
+        return rectify(img, warp)
+    roi = clamp_roi(roi, img.shape[:2])
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        return img[y0:y1, x0:x1]
+    return img
+
+
+def prepare(img):
+    """
+    img in the play area, white-balanced with the gains of the saved
+    background when that is switched on.
+    """
+    img = play_area(img)
+    lut = st.session_state.wb_lut
+    if img is None or lut is None or not st.session_state.white_balance:
+        return img
+    return white_balance(img, lut)
+
+
+def prepared_background(bg):
+    """
+    prepare(bg), reused while bg and the play-area and white-balance
+    settings stay the same, so the incremental pipeline sees the same
+    background array and keeps its tile signature.
+    """
+    inputs = (bg, st.session_state.warp, st.session_state.roi,
+              st.session_state.wb_lut, st.session_state.white_balance)
+    cached = st.session_state.get("prepared_bg")
+    if cached is None or any(a is not b for a, b in zip(cached[0], inputs)):
+        cached = st.session_state.prepared_bg = (inputs, prepare(bg))
+    return cached[1]
+
+
+if ctx.video_processor:
+    ctx.video_processor.palette = palette
+    # slots set on a rectified snapshot are not in camera coordinates
+    ctx.video_processor.slots = st.session_state.slots if st.session_state.warp is None else None
+    ctx.video_processor.roi = st.session_state.roi
+    ctx.video_processor.show_roi = st.session_state.get("show_roi", False)
+    ctx.video_processor.tracking = ctx.video_processor.show_tracks = st.session_state.show_tracks
+    ctx.video_processor.show_slots = st.session_state.show_slots
+
+
+with st.expander("📐 Play Area"):
+    vp = ctx.video_processor
+    frame = st.session_state.snapshot if vp is None or vp.latest is None else vp.latest
+
+    if frame is None:
+        area = parse_roi(st.text_input(
+            "Play-area rectangle in the camera image (x0,y0,x1,y1)",
+            value="" if st.session_state.roi is None else ",".join(map(str, st.session_state.roi)),
+        ))
+    else:
+        # drag the edges over the current frame; the rectangle is drawn on it
+        # (even bounds, as parse_roi keeps them)
+        fh, fw = frame.shape[:2]
+        x0, y0, x1, y1 = clamp_roi(st.session_state.roi, (fh, fw)) or (0, 0, fw & ~1, fh & ~1)
+        left, right = st.slider("Play area left and right edges", 0, fw & ~1, (x0, x1), step=2)
+        top, bottom = st.slider("Play area top and bottom edges", 0, fh & ~1, (y0, y1), step=2)
+        area = (left, top, right, bottom)
+        preview = frame.copy()
+        cv2.rectangle(preview, (left, top), (right - 1, bottom - 1), (0, 255, 0), max(fw // 300, 2))
+        st.image(FrameContext(preview).rgb, use_container_width=True)
+
+    st.checkbox("Show the play area on the live view", key="show_roi")
+    rcol1, rcol2 = st.columns(2)
+
+    with rcol1:
+        if st.button(" Set Play Area"):
+            roi = area
+            if roi is not None and frame is not None:
+                roi = clamp_roi(roi, frame.shape[:2])
+
+            if roi is None:
+                st.error(" Enter the rectangle as x0,y0,x1,y1, overlapping the camera image")
+            else:
+                st.session_state.roi = roi
+                st.session_state.slots = None
+                save_roi(st.session_state.location, roi)
+                st.success(f" Play area saved for {st.session_state.location}")
+
+    with rcol2:
+        if st.button(" Clear Play Area"):
+            st.session_state.roi = None
+            st.session_state.slots = None
+            save_roi(st.session_state.location, None)
+
+    corners = st.text_input(
+        "Corners in the camera image (x,y for each of the four corners)", key="corners"
+    )
+    pcol1, pcol2, pcol3 = st.columns(3)
+
+    with pcol1:
+        if st.button(" Find Corner Markers"):
+            snap = st.session_state.snapshot
+            quad = None if snap is None else find_markers(snap)
+            if quad is None:
+                st.error(" Capture a snapshot showing all four corner markers first")
+            else:
+                st.session_state.warp = homography(quad)
+                st.session_state.slots = None
+                st.success(" Play area set from markers")
+
+    with pcol2:
+        if st.button(" Use These Corners"):
+            quad = parse_quad(corners)
+            if quad is None:
+                st.error(" Enter four x,y corner points")
+            else:
+                st.session_state.warp = homography(quad)
+                st.session_state.slots = None
+                st.success(" Play area set")
+
+    with pcol3:
+        if st.button(" Clear Perspective"):
+            st.session_state.warp = None
+            st.session_state.slots = None
+
+
+col1, col2, col3 = st.columns(3)
 
 with col1:
     if st.button(" Save Background"):
-        if ctx.video_processor and ctx.video_processor.frame is not None:
-            st.session_state.bg_frame = ctx.video_processor.frame.copy()
+        if ctx.video_processor and ctx.video_processor.latest is not None:
+            st.session_state.bg_frame = ctx.video_processor.latest.copy()
+            st.session_state.wb_lut = balance_lut(gray_world_gains(st.session_state.bg_frame))
             ctx.video_processor.bg_saved = True
+            ctx.video_processor.reset_background(st.session_state.bg_frame)
             st.success(" Background saved")
 
 with col2:
     if st.button(" Capture Snapshot"):
-        if ctx.video_processor and ctx.video_processor.frame is not None:
-            st.session_state.snapshot = ctx.video_processor.frame.copy()
+        if ctx.video_processor and ctx.video_processor.latest is not None:
+            st.session_state.snapshot = ctx.video_processor.latest.copy()
             st.success(" Snapshot captured")
 
+with col3:
+    if st.button(" Calibrate Colors"):
+        snap = st.session_state.snapshot
+        if snap is None:
+            st.error(" Place one block of each color and capture a snapshot first")
+        else:
+            snap = prepare(snap)
+            # lighting is read before white balance, which would cancel its cast
+            lighting = play_area(background())
+            bg = prepare(background())
+            mask = None if bg is None else foreground_mask(bg, snap)
+            calibrate(snap, palette, st.session_state.location, mask=mask, background=lighting)
+            calibrate_backprojection(snap, palette, st.session_state.location, mask=mask, background=lighting)
+            st.success(f" Colors calibrated for {st.session_state.location}")
+
+use_slots = st.checkbox("📐 Score fixed slots instead of left-to-right order", key="use_slots")
+match_slots = use_slots and st.checkbox(
+    "🧲 Match detected blocks to the nearest slots", key="match_slots"
+)
+use_grid = st.checkbox("🔢 Blocks are laid out in rows (read row by row)", key="use_grid")
+
+if use_slots and st.button(" Set Slots From Snapshot"):
+    snap = st.session_state.snapshot
+    if snap is None:
+        st.error(" Place a block on every target spot and capture a snapshot first")
+    else:
+        snap = prepare(snap)
+        bg = prepare(background())
+        mask = None if bg is None else foreground_mask(bg, snap)
+        blobs = detect_blobs(snap, palette, mask=mask)
+
+        if len(blobs.label) == len(COLORS):
+            slots = slots_from_blobs(blobs, grid=use_grid)
+        else:
+            box = (0, 0, snap.shape[1], snap.shape[0])
+            if mask is not None and cv2.countNonZero(mask):
+                x, y, w, h = cv2.boundingRect(mask)
+                box = (x, y, x + w, y + h)
+            slots = even_slots(box, len(COLORS))
+
+        st.session_state.slots = slots
+        st.success(f" {len(slots)} slots set")
+
 st.markdown("---")
 
 
 
 if st.button(" Analyze Snapshot "):
 
-    bg = st.session_state.bg_frame
+    bg = background()
     frame = st.session_state.snapshot
 
     if bg is None or frame is None:
         st.error(" Please save background and capture snapshot first")
         st.stop()
 
-    diff = cv2.absdiff(bg, frame)
-    gray = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-    _, mask = cv2.threshold(gray, 40, 255, cv2.THRESH_BINARY)
-    mask = cv2.medianBlur(mask, 5)
-    fg = cv2.bitwise_and(frame, frame, mask=mask)
-
-    detected = detect_colors(fg)
-
-    sorted_colors = sorted(
-        [(c, pos) for c, pos in detected.items() if pos is not None],
-        key=lambda x: x[1][0]
-    )
-
-    detected_order = [c for c, _ in sorted_colors]
-
-    correct, wrong, missing, accuracy = calculate_accuracy(
-        detected_order, st.session_state.current_order
+    # lighting is keyed on the background, not on whichever blocks are
+    # placed, and read before white balance as at calibration time
+    lighting = play_area(bg)
+    bg, frame = prepared_background(bg), prepare(frame)
+    active_palette = load_calibration(lighting, palette, st.session_state.location) or palette
+
+    if backend == "Back-projection":
+        model = load_backprojection(lighting, palette, st.session_state.location)
+        if model is None:
+            st.warning(" No back-projection model for this lighting yet, using thresholds. Calibrate Colors first.")
+        else:
+            active_palette = model
+
+    slots = st.session_state.slots
+    layout = (
+        ("match" if match_slots else "slots") if use_slots and slots is not None else
+        "grid" if use_grid else "row"
     )
+    result = PIPELINE.run(Request(
+        bg, frame, active_palette, st.session_state.current_order, slots, layout,
+        clusters=backend.startswith("Auto clusters"),
+    ))
+    detected_order = result.detected_order
+    correct, wrong, missing, accuracy = result.correct, result.wrong, result.missing, result.accuracy
 
     st.subheader(" Final Frame ")
-    result_img = frame.copy()
+    st.image(FrameContext(result.image).rgb, use_container_width=True)
+    st.caption(" · ".join(f"{stage} {t * 1000:.1f} ms" for stage, t in result.timings.items()))
 
-    for i, (color, (x, y)) in enumerate(sorted_colors):
-        if i < len(st.session_state.current_order) and color == st.session_state.current_order[i]:
-            cv2.rectangle(result_img, (x-50, y-50), (x+50, y+50), (0,255,0), 3)
-            cv2.putText(result_img, f"{color} ✔", (x-40, y-60),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
-
-    st.image(cv2.cvtColor(result_img, cv2.COLOR_BGR2RGB), use_container_width=True)
+    if result.reason is not None:
+        st.warning(f" Nothing placed yet: {result.reason}")
+        st.stop()
 
     st.markdown("### 🎯 Target Order")
     st.success(" → ".join(st.session_state.current_order))
 
     st.markdown("### 🔍 Detected Order")
-    st.info(" → ".join(detected_order) if detected_order else "No colors detected")
+    st.info(" → ".join(c or "—" for c in detected_order) if any(detected_order) else "No colors detected")
 
  
     st.subheader("📊 Result Pie Chart")
@@ -153,6 +380,7 @@ if st.button(" Analyze Snapshot "):
     data = {
         "Child Name": st.session_state.child_name,
         "Location": st.session_state.location,
+        "Palette": palette.name,
         "Target Order": st.session_state.current_order,
         "Detected Order": detected_order,
         "Correct": correct,
@@ -2,25 +2,29 @@ import streamlit as st
 import cv2
 import numpy as np
 from streamlit_webrtc import webrtc_streamer, VideoProcessorBase, WebRtcMode
-import av
+
+from utils.frame_context import FrameContext
 
 
 class CameraVideoProcessor(VideoProcessorBase):
     def __init__(self):
-        self.frame = None
+        self.latest = None
+
+    @property
+    def frame(self):
+        latest = self.latest
+        return None if latest is None else latest.bgr
 
     def recv(self, frame):
-        self.frame = frame.to_ndarray(format="bgr24")
-        return av.VideoFrame.from_ndarray(self.frame, format="bgr24")
+        self.latest = FrameContext.from_av(frame)
+        return frame
 
 
 
 def compare_faces(img1, img2):
     
-    if len(img1.shape) == 3:
-        img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    if len(img2.shape) == 3:
-        img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    img1 = FrameContext.wrap(img1).gray
+    img2 = FrameContext.wrap(img2).gray
 
    
     img1 = cv2.resize(img1, (200, 200))
@@ -74,7 +78,7 @@ def login_ui():
         if reg_ctx.video_processor and reg_ctx.video_processor.frame is not None:
             st.session_state.registered_face = reg_ctx.video_processor.frame.copy()
             st.sidebar.image(
-                cv2.cvtColor(st.session_state.registered_face, cv2.COLOR_BGR2RGB),
+                FrameContext.wrap(st.session_state.registered_face).rgb,
                 caption="Registered Photo"
             )
             st.sidebar.success("✅ Registered photo captured")
@@ -0,0 +1,259 @@
+import json
+import os
+import re
+
+import cv2
+import numpy as np
+
+from utils.color_detection import MIN_AREA, label_image
+from utils.detectors import backprojection_model, get_model
+from utils.frame_context import FrameContext
+from utils.ordering import assign_to_targets
+from utils.palettes import LUT_SHAPE, Palette, build_lut, ranges_digest
+
+CALIBRATION_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "output", "calibration"
+)
+
+# Calibrated palettes keyed by (location, base palette key, lighting signature).
+_cache = {}
+
+
+def lighting_signature(frame, step=16):
+    """
+    Coarse key for the scene lighting: overall brightness plus the red/blue
+    cast relative to green, quantized so small flicker maps to the same key.
+    """
+    small = cv2.resize(FrameContext.wrap(frame).bgr, (32, 32), interpolation=cv2.INTER_AREA)
+    b, g, r = small.reshape(-1, 3).mean(axis=0)
+    g = max(g, 1.0)
+    return f"{int((b + g + r) / 3) // step}-{int(r / g * 8)}-{int(b / g * 8)}"
+
+
+def _hue_bounds(hue, percentiles, margin):
+    """
+    Tight hue range of the samples. Hue is circular, so the samples are also
+    measured shifted by half a turn and the narrower of the two spans wins;
+    a span that crosses 0/179 comes back as two ranges.
+    """
+    lo, hi = np.percentile(hue, percentiles)
+    slo, shi = np.percentile((hue.astype(np.int16) + 90) % 180, percentiles)
+
+    if shi - slo < hi - lo:
+        lo, hi = slo - 90, shi - 90
+
+    lo, hi = int(np.floor(lo)) - margin, int(np.ceil(hi)) + margin
+
+    if lo < 0:
+        return [(0, min(hi, 179)), (180 + lo, 179)] if hi >= 0 else [(180 + lo, 180 + hi)]
+    if hi > 179:
+        return [(lo, 179), (0, hi - 180)] if lo <= 179 else [(lo - 180, hi - 180)]
+    return [(lo, hi)]
+
+
+def _hue_point(hue, weights=None):
+    """
+    Mean direction of OpenCV hues (0-179) as a point on the unit circle, so
+    that distances between points follow the circular hue distance.
+    """
+    angle = np.asarray(hue, float) * (np.pi / 90)
+    point = np.array([np.average(np.cos(angle), weights=weights), np.average(np.sin(angle), weights=weights)])
+    return point / max(np.hypot(*point), 1e-9)
+
+
+def sample_blocks(frame, palette, mask=None, min_area=MIN_AREA, max_shift=45):
+    """
+    One block per color from a calibration snapshot, as
+    {color: (bbox, mask of the block's colored pixels inside bbox)}.
+
+    Blocks are the components of mask (of the pixels any palette color
+    matches when there is no mask). Each is matched, one block per color,
+    to the color whose hue range is centered nearest its mean hue, so a
+    block that the lighting pushed outside the default ranges is still
+    sampled. Blocks more than max_shift hue steps from every color, and
+    pixels less saturated than any range allows, are left out.
+    """
+    frame = FrameContext.wrap(frame)
+    hsv = frame.hsv
+    if mask is None:
+        mask = cv2.compare(label_image(frame, palette), 0, cv2.CMP_GT)
+
+    s_min = min(lo[1] for bounds in palette.ranges.values() for lo, _ in bounds)
+    _, cc, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    blocks, points = [], []
+
+    for k in (np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= min_area) + 1).tolist():
+        x, y, w, h = stats[k, :4].tolist()
+        block = cv2.bitwise_and(
+            cv2.compare(cc[y:y + h, x:x + w], k, cv2.CMP_EQ),
+            cv2.compare(hsv[y:y + h, x:x + w, 1], s_min, cv2.CMP_GE),
+        )
+        if cv2.countNonZero(block) < min_area:
+            continue
+
+        pixels = hsv[y:y + h, x:x + w][block > 0]
+        blocks.append(((x, y, w, h), block))
+        points.append(_hue_point(pixels[:, 0], pixels[:, 1]))
+
+    if not blocks:
+        return {}
+
+    centers = np.array([
+        _hue_point(np.concatenate([np.arange(lo[0], hi[0] + 1) for lo, hi in palette.ranges[color]]))
+        for color in palette.colors
+    ])
+    match = assign_to_targets(np.array(points), centers, 2 * np.sin(max_shift * np.pi / 180))
+    return {color: blocks[i] for color, i in zip(palette.colors, match.tolist()) if i >= 0}
+
+
+def derive_ranges(frame, palette, mask=None, min_area=MIN_AREA,
+                  percentiles=(2, 98), margin=(3, 25, 25)):
+    """
+    Returns HSV ranges tightened around the observed pixels of each color.
+    Colors that are not on the table keep their original ranges.
+    """
+    frame = FrameContext.wrap(frame)
+    hsv = frame.hsv
+    blocks = sample_blocks(frame, palette, mask, min_area)
+    ranges = {}
+
+    for color in palette.colors:
+        if color not in blocks:
+            ranges[color] = palette.ranges[color]
+            continue
+
+        (x, y, w, h), block = blocks[color]
+        samples = hsv[y:y + h, x:x + w][block > 0]
+
+        s_lo, s_hi = np.percentile(samples[:, 1], percentiles)
+        v_lo, v_hi = np.percentile(samples[:, 2], percentiles)
+        s_lo, s_hi = max(int(s_lo) - margin[1], 0), min(int(s_hi) + margin[1], 255)
+        v_lo, v_hi = max(int(v_lo) - margin[2], 0), min(int(v_hi) + margin[2], 255)
+
+        ranges[color] = [
+            ((h0, s_lo, v_lo), (h1, s_hi, v_hi))
+            for h0, h1 in _hue_bounds(samples[:, 0], percentiles, margin[0])
+        ]
+
+    return ranges
+
+
+def _site(location):
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", location.strip()) or "default"
+
+
+def _path(location, palette, signature):
+    return os.path.join(
+        CALIBRATION_DIR, f"{_site(location)}_{palette.name}_v{palette.version}_{signature}.npz"
+    )
+
+
+def _version(signature, ranges):
+    """
+    Palette version of a calibration: the lighting signature plus a digest
+    of the ranges, so recalibrating under the same lighting gets a new
+    compiled table (and a new detector key).
+    """
+    return f"{signature}-{ranges_digest(ranges)}"
+
+
+def calibrate(frame, palette, location, mask=None, background=None):
+    """
+    Builds a calibrated copy of palette from a calibration snapshot, compiles
+    its lookup table and stores it for this location and lighting. The
+    lighting is read from background when given, since the snapshot's own
+    colors depend on which blocks are on the table.
+    """
+    frame = FrameContext.wrap(frame)
+    signature = lighting_signature(frame if background is None else background)
+    ranges = derive_ranges(frame, palette, mask)
+    lut = build_lut(ranges)
+    calibrated = Palette(
+        f"{palette.name}@{location.strip()}", ranges, version=_version(signature, ranges), lut=lut
+    )
+
+    os.makedirs(CALIBRATION_DIR, exist_ok=True)
+    np.savez_compressed(
+        _path(location, palette, signature),
+        lut=lut,
+        ranges=json.dumps(list(calibrated.ranges.items())),
+    )
+
+    _cache[(location, palette.key, signature)] = calibrated
+    return calibrated
+
+
+def calibrate_backprojection(frame, palette, location, mask=None, background=None):
+    """
+    Hue-saturation histogram model of the blocks in a calibration snapshot,
+    cached for this location and lighting (read from background when given).
+    """
+    frame = FrameContext.wrap(frame)
+    patches = {
+        color: [(frame[y:y + h, x:x + w], block)]
+        for color, ((x, y, w, h), block) in sample_blocks(frame, palette, mask).items()
+    }
+    return backprojection_model(
+        f"{palette.name}@{location.strip()}", patches,
+        version=lighting_signature(frame if background is None else background), rebuild=True
+    )
+
+
+def load_backprojection(frame, palette, location):
+    """
+    frame -> the background the lighting is read from
+    """
+    return get_model(f"{palette.name}@{location.strip()}", lighting_signature(frame))
+
+
+def load_calibration(frame, palette, location):
+    """
+    Calibrated palette for this location under the lighting seen in frame
+    (the background, as at calibration time), or None if the site has not
+    been calibrated for it yet.
+    """
+    signature = lighting_signature(frame)
+    key = (location, palette.key, signature)
+
+    if key in _cache:
+        return _cache[key]
+
+    path = _path(location, palette, signature)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as data:
+        ranges = dict(json.loads(str(data["ranges"])))
+        # tables saved in an older layout are rebuilt from the ranges
+        lut = data["lut"] if data["lut"].shape == LUT_SHAPE else None
+        calibrated = Palette(
+            f"{palette.name}@{location.strip()}", ranges, version=_version(signature, ranges), lut=lut
+        )
+
+    _cache[key] = calibrated
+    return calibrated
+
+
+def save_roi(location, roi):
+    """
+    Stores the play-area rectangle (x0, y0, x1, y1) for this location;
+    None forgets it.
+    """
+    path = os.path.join(CALIBRATION_DIR, f"{_site(location)}_roi.json")
+    if roi is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    os.makedirs(CALIBRATION_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump([int(v) for v in roi], f)
+
+
+def load_roi(location):
+    path = os.path.join(CALIBRATION_DIR, f"{_site(location)}_roi.json")
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return tuple(json.load(f))
@@ -1,23 +1,511 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
 
-def detect_colors(frame):
-    colors = {
-        "Red": ((0, 120, 70), (10, 255, 255)),
-        "Blue": ((94, 80, 2), (126, 255, 255)),
-        "Green": ((40, 40, 40), (70, 255, 255))
-    }
+from utils.detectors import as_detector
+from utils.frame_context import FrameContext
+from utils.palettes import get_palette
+
+MIN_AREA = 100
+
+# One entry per blob: label is the 1-based color index, bbox is (x, y, w, h),
+# centroid is the sub-pixel (x, y) mean of the blob's pixels, fill is
+# area / bbox area and orientation is the major axis angle in radians.
+Blobs = namedtuple("Blobs", "label area bbox centroid fill orientation")
+
+_pool = None
+_pool_size = 0
+
+
+def get_pool(workers=None):
+    """
+    Thread pool shared by the batch and tiled paths. OpenCV releases the GIL,
+    so threads are enough to keep several cores busy. Asking for more
+    workers than the current pool has replaces it with a bigger one.
+    """
+    global _pool, _pool_size
+    workers = workers or os.cpu_count() or 4
+
+    if _pool is None or _pool_size < workers:
+        old = _pool
+        _pool, _pool_size = ThreadPoolExecutor(max_workers=workers), workers
+        if old is not None:
+            old.shutdown(wait=False)
+
+    return _pool
+
+
+def empty_blobs():
+    return Blobs(
+        np.empty(0, np.uint8), np.empty(0, np.int32), np.empty((0, 4), np.int32),
+        np.empty((0, 2), np.float64), np.empty(0, np.float32), np.empty(0, np.float32)
+    )
+
+
+def concat_blobs(parts):
+    parts = [b for b in parts if len(b.label)]
+    if not parts:
+        return empty_blobs()
+    if len(parts) == 1:
+        return parts[0]
+    return Blobs(*(np.concatenate(field) for field in zip(*parts)))
+
+
+def offset_blobs(blobs, dx, dy):
+    """
+    Moves blobs found in a crop back to the coordinates of the full frame.
+    """
+    if dx == 0 and dy == 0:
+        return blobs
+
+    bbox = blobs.bbox.copy()
+    bbox[:, 0] += dx
+    bbox[:, 1] += dy
+    return blobs._replace(bbox=bbox, centroid=blobs.centroid + (dx, dy))
+
+
+def mask_regions(mask, min_area=MIN_AREA, pad=4):
+    """
+    Padded bounding boxes (x0, y0, x1, y1) of the nonzero regions of a mask.
+    Overlapping boxes are merged so no pixel is scanned twice.
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    stats = stats[1:][stats[1:, cv2.CC_STAT_AREA] >= min_area]
+    h, w = mask.shape[:2]
+
+    return merge_boxes([
+        [max(x - pad, 0), max(y - pad, 0), min(x + bw + pad, w), min(y + bh + pad, h)]
+        for x, y, bw, bh in stats[:, :4].tolist()
+    ])
+
+
+def merge_boxes(boxes):
+    """
+    Boxes (x0, y0, x1, y1) with every overlapping pair merged into its
+    bounding box, until none overlap.
+    """
+    boxes = [list(box) for box in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(len(boxes) - 1, i, -1):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+
+    return boxes
+
+
+def region_moments(cc, n, dx=0, dy=0):
+    """
+    Raw moments (m00, m10, m01, m20, m02, m11) of components 1..n-1 of a
+    connected-component label image, in one vectorized pass over its
+    foreground pixels. dx, dy shift the coordinates (crop offsets).
+    """
+    flat = cc.reshape(-1)
+    idx = np.flatnonzero(flat)
+    component = flat[idx] - 1
+    y, x = np.divmod(idx, cc.shape[1])
+    x = x + float(dx)
+    y = y + float(dy)
+
+    moments = np.empty((n - 1, 6))
+    for j, weights in enumerate((None, x, y, x * x, y * y, x * y)):
+        moments[:, j] = np.bincount(component, weights, minlength=n - 1)
+    return moments
+
+
+def moment_shape(moments):
+    """
+    Centroids (x, y) and major-axis orientations, in radians within
+    (-pi/2, pi/2], from raw moments.
+    """
+    m00, m10, m01, m20, m02, m11 = moments.T
+    cx, cy = m10 / m00, m01 / m00
+    mu20 = m20 / m00 - cx * cx
+    mu02 = m02 / m00 - cy * cy
+    mu11 = m11 / m00 - cx * cy
+    return np.stack([cx, cy], axis=1), axis_angle(mu20, mu02, mu11)
+
+
+def axis_angle(mu20, mu02, mu11):
+    """
+    Major-axis orientations, in radians within (-pi/2, pi/2], from second
+    central moments (any common scale).
+    """
+    orientation = 0.5 * np.arctan2(2 * np.asarray(mu11, float), np.subtract(mu20, mu02, dtype=float))
+    orientation[orientation <= -np.pi / 2] += np.pi
+    return orientation.astype(np.float32)
+
+
+def _coarse_regions(mask, cell):
+    """
+    Connected components of mask downsampled to one pixel per cell x cell
+    block (set when any pixel in the block is). Every component of the
+    full-resolution mask lies inside exactly one coarse component.
+    """
+    h, w = mask.shape
+    ph, pw = -h % cell, -w % cell
+    if ph or pw:
+        mask = cv2.copyMakeBorder(mask, 0, ph, 0, pw, cv2.BORDER_CONSTANT, value=0)
+    small = cv2.resize(mask, ((w + pw) // cell, (h + ph) // cell), interpolation=cv2.INTER_AREA)
+    n, cc, stats, _ = cv2.connectedComponentsWithStats(small, connectivity=8)
+    return n, cc, stats
+
+
+def find_blobs(labels, n_labels, min_area=MIN_AREA, cell=4):
+    """
+    Connected components of every color in a label image. Blobs smaller
+    than min_area pixels are dropped.
+
+    The colored pixels are first grouped into regions on a grid of
+    cell x cell blocks; each color is then split into components only
+    inside the regions large enough to hold a blob, so the full-frame work
+    is one compare and one small downsample whatever the number of colors.
+    Centroids come from the component stats and orientations from each
+    component's own bounding box, never from a scan of the whole frame.
+    """
+    h, w = labels.shape
+    _, coarse, stats = _coarse_regions(cv2.compare(labels, 0, cv2.CMP_GT), cell)
+    parts = []
+
+    for region in (np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] * cell * cell >= min_area) + 1).tolist():
+        cx, cy, cw, ch = stats[region, :4].tolist()
+        x, y = cx * cell, cy * cell
+        x1, y1 = min((cx + cw) * cell, w), min((cy + ch) * cell, h)
+
+        # numpy compares here: cv2.compare rejects 1x1 inputs with a scalar
+        owner = (coarse[cy:cy + ch, cx:cx + cw] == region).view(np.uint8)
+        inside = cv2.resize(owner, (cw * cell, ch * cell), interpolation=cv2.INTER_NEAREST)
+        crop = labels[y:y1, x:x1] * inside[:y1 - y, :x1 - x]
+        present = np.bincount(crop.reshape(-1), minlength=n_labels + 1)
+
+        for label in (np.flatnonzero(present[1:] >= min_area) + 1).tolist():
+            mask = (crop == label).view(np.uint8)
+            _, cc, st, centroid = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            keep = np.flatnonzero(st[1:, cv2.CC_STAT_AREA] >= min_area) + 1
+            if not len(keep):
+                continue
+
+            central = np.empty((len(keep), 3))
+            for j, k in enumerate(keep.tolist()):
+                bx, by, bw, bh = st[k, :4].tolist()
+                m = cv2.moments((cc[by:by + bh, bx:bx + bw] == k).view(np.uint8), True)
+                central[j] = m["mu20"], m["mu02"], m["mu11"]
+
+            st = st[keep]
+            st[:, 0] += x
+            st[:, 1] += y
+            parts.append((label, st, centroid[keep] + (x, y), axis_angle(*central.T)))
+
+    if not parts:
+        return empty_blobs()
+
+    # Grouped by color, as one pass per color would list them.
+    parts.sort(key=lambda part: part[0])
+    label = np.concatenate([np.full(len(part[1]), part[0], np.uint8) for part in parts])
+    stats = np.concatenate([part[1] for part in parts])
+    centroid = np.concatenate([part[2] for part in parts])
+    orientation = np.concatenate([part[3] for part in parts])
+    area = stats[:, cv2.CC_STAT_AREA].astype(np.int32)
+    bbox = stats[:, :4].astype(np.int32)
+    fill = (area / (bbox[:, 2] * bbox[:, 3])).astype(np.float32)
+
+    return Blobs(label, area, bbox, centroid, fill, orientation)
+
+
+def label_image(frame, palette, mask=None):
+    """
+    frame   -> FrameContext or BGR ndarray
+    palette -> a Palette (LUT thresholds) or any detector from utils.detectors
+    """
+    labels = as_detector(palette).label_image(FrameContext.wrap(frame))
+    if mask is not None:
+        cv2.bitwise_and(labels, mask, dst=labels)
+    return labels
+
+
+def blob_near(frame, palette, label, window, target, mask=None, min_area=1):
+    """
+    Classifies only window (x0, y0, x1, y1) of the frame and returns the
+    component of color label, of at least min_area pixels, whose centroid
+    is closest to target (x, y), as a one-entry Blobs in full-frame
+    coordinates, or None.
+    """
+    x0, y0, x1, y1 = window
+    labels = label_image(
+        frame[y0:y1, x0:x1], palette, None if mask is None else mask[y0:y1, x0:x1]
+    )
+
+    n, cc, stats, _ = cv2.connectedComponentsWithStats(
+        cv2.compare(labels, int(label), cv2.CMP_EQ), connectivity=8
+    )
+    keep = np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= min_area)
+    if not len(keep):
+        return None
+
+    centroids, orientations = moment_shape(region_moments(cc, n, x0, y0)[keep])
+    j = np.argmin(((centroids - target) ** 2).sum(axis=1))
+    area = int(stats[keep[j] + 1, cv2.CC_STAT_AREA])
+    bx, by, bw, bh = stats[keep[j] + 1, :4]
 
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    return Blobs(
+        np.array([label], np.uint8),
+        np.array([area], np.int32),
+        np.array([[bx + x0, by + y0, bw, bh]], np.int32),
+        centroids[j:j + 1],
+        np.array([area / (bw * bh)], np.float32),
+        orientations[j:j + 1],
+    )
+
+
+def _refine(frame, mask, palette, coarse, scale, min_area=1, threads=1):
+    """
+    Re-measures coarse blobs at full resolution, classifying only a small
+    window around each one. Specks under min_area pixels next to a blob
+    are not mistaken for it.
+    """
+    h, w = frame.shape[:2]
+
+    def refine(label, bbox, centroid):
+        (x, y, bw, bh), (cx, cy) = bbox, centroid
+        window = (
+            max((x - 1) * scale, 0), max((y - 1) * scale, 0),
+            min((x + bw + 1) * scale, w), min((y + bh + 1) * scale, h),
+        )
+        target = ((cx + 0.5) * scale - 0.5, (cy + 0.5) * scale - 0.5)
+        return blob_near(frame, palette, label, window, target, mask, min_area)
+
+    blobs = zip(coarse.label, coarse.bbox, coarse.centroid)
+    if threads > 1:
+        parts = get_pool(threads).map(lambda b: refine(*b), blobs)
+    else:
+        parts = [refine(*b) for b in blobs]
+
+    return concat_blobs([b for b in parts if b is not None])
+
+
+def _band_components(frame, mask, palette, y0, y1):
+    labels = label_image(frame[y0:y1, :], palette, None if mask is None else mask[y0:y1])
+    present = np.bincount(labels.reshape(-1), minlength=len(palette.colors) + 1)
+    components = {}
+
+    for label in (np.flatnonzero(present[1:]) + 1).tolist():
+        n, cc, stats, _ = cv2.connectedComponentsWithStats(
+            cv2.compare(labels, label, cv2.CMP_EQ), connectivity=8
+        )
+        stats = stats[1:].copy()
+        stats[:, cv2.CC_STAT_TOP] += y0
+        components[label] = (cc, stats, region_moments(cc, n, 0, y0))
+
+    return components
+
+
+def _merge_bands(bands, min_area):
+    """
+    Joins per-band components of the same color that touch across a band
+    boundary (8-connected) and sums up their stats.
+    """
+    parts = []
+
+    for label in sorted(set().union(*bands)):
+        offsets, stats, moments = [], [], []
+        total = 0
+        for band in bands:
+            offsets.append(total if label in band else None)
+            if label in band:
+                stats.append(band[label][1])
+                moments.append(band[label][2])
+                total += len(band[label][1])
+
+        parent = list(range(total))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(bands) - 1):
+            if offsets[i] is None or offsets[i + 1] is None:
+                continue
+
+            top, bottom = bands[i][label][0][-1], bands[i + 1][label][0][0]
+            w = len(top)
+            for shift in (-1, 0, 1):
+                a = top[max(shift, 0):w + min(shift, 0)]
+                b = bottom[max(-shift, 0):w + min(-shift, 0)]
+                touching = (a > 0) & (b > 0)
+                pairs = np.unique(np.stack([a[touching], b[touching]], axis=1), axis=0)
+
+                for p, q in pairs.tolist():
+                    root_p, root_q = find(p - 1 + offsets[i]), find(q - 1 + offsets[i + 1])
+                    if root_p != root_q:
+                        parent[root_q] = root_p
+
+        stats = np.concatenate(stats)
+        moments = np.concatenate(moments)
+        _, group = np.unique([find(i) for i in range(total)], return_inverse=True)
+        n = group.max() + 1
+
+        area = np.zeros(n, np.int64)
+        np.add.at(area, group, stats[:, cv2.CC_STAT_AREA])
+        x0 = np.full(n, np.iinfo(np.int32).max)
+        y0 = np.full(n, np.iinfo(np.int32).max)
+        x1 = np.zeros(n, np.int64)
+        y1 = np.zeros(n, np.int64)
+        np.minimum.at(x0, group, stats[:, 0])
+        np.minimum.at(y0, group, stats[:, 1])
+        np.maximum.at(x1, group, stats[:, 0] + stats[:, 2])
+        np.maximum.at(y1, group, stats[:, 1] + stats[:, 3])
+        merged = np.zeros((n, 6))
+        np.add.at(merged, group, moments)
+
+        keep = area >= min_area
+        bbox = np.stack([x0, y0, x1 - x0, y1 - y0], axis=1)[keep].astype(np.int32)
+        area = area[keep].astype(np.int32)
+        centroid, orientation = moment_shape(merged[keep])
+
+        parts.append(Blobs(
+            np.full(len(area), label, np.uint8),
+            area,
+            bbox,
+            centroid,
+            (area / (bbox[:, 2] * bbox[:, 3])).astype(np.float32),
+            orientation,
+        ))
+
+    return concat_blobs(parts)
+
+
+def _tiled_blobs(frame, mask, palette, min_area, threads):
+    """
+    Classifies horizontal bands of the frame in parallel on the shared pool,
+    then merges the blobs cut by band boundaries.
+    """
+    h = frame.shape[0]
+    edges = np.linspace(0, h, min(threads, h) + 1).astype(int).tolist()
+    bands = get_pool(threads).map(
+        lambda i: _band_components(frame, mask, palette, edges[i], edges[i + 1]),
+        range(len(edges) - 1),
+    )
+    return _merge_bands(list(bands), min_area)
+
+
+def _blobs_in(frame, mask, palette, min_area, downscale=1, refine=True, threads=1):
+    if downscale <= 1:
+        if threads > 1:
+            return _tiled_blobs(frame, mask, palette, min_area, threads)
+        return find_blobs(label_image(frame, palette, mask), len(palette.colors), min_area)
+
+    small = frame.scaled(downscale)
+    size = small.size[::-1]
+    small_mask = None if mask is None else cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+    coarse = _blobs_in(
+        small, small_mask, palette, max(min_area // (downscale * downscale), 1), threads=threads
+    )
+
+    if not refine:
+        return coarse._replace(
+            area=coarse.area * downscale * downscale,
+            bbox=coarse.bbox * downscale,
+            centroid=(coarse.centroid + 0.5) * downscale - 0.5,
+        )
+
+    return _refine(frame, mask, palette, coarse, downscale, min_area, threads)
+
+
+def detect_blobs(frame, palette=None, min_area=MIN_AREA, mask=None, roi=None,
+                 downscale=1, refine=True, threads=1):
+    """
+    mask      -> optional foreground mask; only the boxes around its nonzero
+                 regions are converted and classified
+    roi       -> optional (x, y, w, h) crop applied first
+    downscale -> 1 scans at full resolution; 2, 4 or 8 find blobs on a
+                 smaller frame first (faster, may miss blobs that shrink
+                 below min_area / downscale**2)
+    refine    -> with downscale > 1, re-measure each blob at full resolution
+                 in a small window around it; False is fastest but coarsest
+    threads   -> split classification into this many horizontal bands run
+                 on the shared thread pool
+    Blob coordinates are always in the full frame.
+    """
+    palette = palette or get_palette()
+    frame = FrameContext.wrap(frame)
+
+    if roi is not None:
+        x, y, w, h = roi
+        frame = frame[y:y + h, x:x + w]
+        if mask is not None:
+            mask = mask[y:y + h, x:x + w]
+        blobs = detect_blobs(frame, palette, min_area, mask, None, downscale, refine, threads)
+        return offset_blobs(blobs, x, y)
+
+    if mask is None:
+        return _blobs_in(frame, None, palette, min_area, downscale, refine, threads)
+
+    return concat_blobs([
+        offset_blobs(_blobs_in(
+            frame[y0:y1, x0:x1], mask[y0:y1, x0:x1], palette, min_area, downscale, refine, threads
+        ), x0, y0)
+        for x0, y0, x1, y1 in mask_regions(mask, min_area)
+    ])
+
+
+def detect_blobs_batch(frames, palette=None, min_area=MIN_AREA):
+    """
+    frames -> (N, H, W, 3) uint8 array or a list of BGR frames
+    Same-sized frames are converted and classified as one tall image, then
+    blobs are extracted per frame on the shared pool.
+    """
+    palette = palette or get_palette()
+    n_labels = len(palette.colors)
+
+    if len(frames) == 0:
+        return []
+
+    if not isinstance(frames, np.ndarray):
+        frames = [FrameContext.wrap(f).bgr for f in frames]
+        if len({f.shape for f in frames}) > 1:
+            return list(get_pool().map(lambda f: detect_blobs(f, palette, min_area), frames))
+        frames = np.stack(frames)
+
+    n, h, w, _ = frames.shape
+    labels = label_image(np.ascontiguousarray(frames).reshape(n * h, w, 3), palette).reshape(n, h, w)
+
+    return list(get_pool().map(lambda l: find_blobs(l, n_labels, min_area), labels))
+
+
+def largest_per_color(blobs, palette):
+    """
+    Sub-pixel centroid of the largest blob of each color, keyed by color
+    name, as float (x, y).
+    """
     detected = {}
 
-    for color, (lower, upper) in colors.items():
-        mask = cv2.inRange(hsv, np.array(lower), np.array(upper))
-        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for label, color in enumerate(palette.colors, 1):
+        idx = np.flatnonzero(blobs.label == label)
+
+        if len(idx):
+            x, y = blobs.centroid[idx[np.argmax(blobs.area[idx])]]
+            detected[color] = (float(x), float(y))
+
+    return detected
+
+
+def detect_colors(frame, palette=None, min_area=MIN_AREA, mask=None, roi=None,
+                  downscale=1, refine=True, threads=1):
+    palette = palette or get_palette()
+    blobs = detect_blobs(frame, palette, min_area, mask, roi, downscale, refine, threads)
+    return largest_per_color(blobs, palette)
 
-        if contours:
-            c = max(contours, key=cv2.contourArea)
-            x, y, w, h = cv2.boundingRect(c)
-            detected[color] = (x + w // 2, y + h // 2)
 
-    return detected
\ No newline at end of file
+def detect_colors_batch(frames, palette=None, min_area=MIN_AREA):
+    palette = palette or get_palette()
+    return [largest_per_color(b, palette) for b in detect_blobs_batch(frames, palette, min_area)]
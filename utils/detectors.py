@@ -0,0 +1,240 @@
+import itertools
+
+import cv2
+import numpy as np
+
+from utils.frame_context import FrameContext
+from utils.palettes import classify
+
+# Histogram models keyed by (name, version).
+_models = {}
+
+# Every histogram model built gets a new revision, so a rebuilt model never
+# shares a key with the one it replaces.
+_revisions = itertools.count(1)
+
+# Lower hue bound of each name, used to name discovered clusters.
+HUE_NAMES = [
+    (0, "Red"), (7, "Orange"), (21, "Yellow"), (36, "Green"), (81, "Cyan"),
+    (94, "Blue"), (127, "Purple"), (156, "Pink"), (172, "Red"),
+]
+
+
+class Detector:
+    """
+    Common interface of the color backends. colors are the color names in
+    label order, key identifies the compiled model, and label_image takes a
+    FrameContext and returns a uint8 image where 0 is background and i is
+    colors[i - 1].
+    """
+
+    name = ""
+    colors = []
+
+    @property
+    def key(self):
+        raise NotImplementedError
+
+    def label_image(self, frame):
+        raise NotImplementedError
+
+
+class ThresholdDetector(Detector):
+    """
+    The palette's HSV ranges, applied through its compiled lookup table.
+    """
+
+    def __init__(self, palette):
+        self.palette = palette
+        self.name = palette.name
+        self.colors = palette.colors
+
+    @property
+    def key(self):
+        return self.palette.key
+
+    def label_image(self, frame):
+        return classify(frame.hsv, self.palette.lut)
+
+
+class BackProjectionDetector(Detector):
+    """
+    Hue-saturation histogram per color; every pixel goes to the color whose
+    back-projection is strongest, if it reaches threshold (0-255).
+    """
+
+    def __init__(self, name, hists, version=1, threshold=40):
+        self.name = name
+        self.version = version
+        self.hists = hists
+        self.colors = list(hists)
+        self.threshold = threshold
+        self.revision = next(_revisions)
+
+    @property
+    def key(self):
+        return ("backproject", self.name, self.version, self.revision)
+
+    def label_image(self, frame):
+        hsv = frame.hsv
+        best = np.zeros(hsv.shape[:2], np.uint8)
+        labels = np.zeros(hsv.shape[:2], np.uint8)
+
+        for label, hist in enumerate(self.hists.values(), 1):
+            prob = cv2.calcBackProject([hsv], [0, 1], hist, [0, 180, 0, 256], 1)
+            stronger = prob > best
+            best[stronger] = prob[stronger]
+            labels[stronger] = label
+
+        labels[best < self.threshold] = 0
+        return labels
+
+
+def hue_name(hue):
+    name = HUE_NAMES[0][1]
+    for lower, n in HUE_NAMES:
+        if hue >= lower:
+            name = n
+    return name
+
+
+def _chroma(hue, sat):
+    angle = hue.astype(np.float32) * (np.pi / 90)
+    sat = sat.astype(np.float32)
+    return np.stack([sat * np.cos(angle), sat * np.sin(angle)], axis=-1)
+
+
+class ClusterDetector(Detector):
+    """
+    Colors discovered from the image itself. centers are cluster centers in
+    the hue/saturation plane (saturation-scaled hue vectors, so red's
+    wrap-around is continuous); pixels go to the nearest one through a
+    precomputed hue x saturation table.
+    """
+
+    def __init__(self, centers, min_saturation=60, min_value=40):
+        order = np.argsort(np.arctan2(centers[:, 1], centers[:, 0]) % (2 * np.pi), kind="stable")
+        self.centers = centers[order]
+        self.min_saturation = min_saturation
+        self.min_value = min_value
+
+        hues = (np.degrees(np.arctan2(self.centers[:, 1], self.centers[:, 0])) % 360) / 2
+        names = [hue_name(h) for h in hues]
+        self.colors = [
+            n if n not in names[:i] else f"{n} {names[:i + 1].count(n)}"
+            for i, n in enumerate(names)
+        ]
+        self.name = "clusters"
+
+        h, s = np.meshgrid(np.arange(180), np.arange(256), indexing="ij")
+        d = ((_chroma(h, s)[:, :, None, :] - self.centers) ** 2).sum(axis=-1)
+        lut = (d.argmin(axis=-1) + 1).astype(np.uint8)
+        lut[:, :min_saturation] = 0
+        self.lut = lut
+
+    @property
+    def key(self):
+        return ("clusters", tuple(np.round(self.centers).astype(int).ravel().tolist()))
+
+    def label_image(self, frame):
+        hsv = frame.hsv
+        idx = (hsv[..., 0].astype(np.uint16) << 8) | hsv[..., 1]
+        labels = self.lut.reshape(-1).take(idx)
+        labels[hsv[..., 2] < self.min_value] = 0
+        return labels
+
+
+def fit_clusters(frame, mask=None, k=6, budget=4000, batch=256, iterations=30,
+                 min_saturation=60, min_value=40, min_share=0.03, merge_distance=40, seed=0):
+    """
+    Mini-batch k-means on a strided sample of at most budget colored pixels,
+    so the cost does not grow with the frame resolution. Clusters holding
+    less than min_share of the sample are dropped and centers closer than
+    merge_distance are merged. Returns a ClusterDetector, or None if the
+    sample has no colored pixels.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = frame.shape[:2]
+    step = max(1, int(np.sqrt(h * w / (4 * budget))))
+
+    hsv = FrameContext.wrap(frame)[::step, ::step].hsv.reshape(-1, 3)
+    keep = (hsv[:, 1] >= min_saturation) & (hsv[:, 2] >= min_value)
+    if mask is not None:
+        keep &= mask[::step, ::step].reshape(-1) > 0
+
+    hsv = hsv[keep]
+    if len(hsv) > budget:
+        hsv = hsv[rng.choice(len(hsv), budget, replace=False)]
+    if len(hsv) < k:
+        return None
+
+    x = _chroma(hsv[:, 0], hsv[:, 1])
+
+    # k-means++ seeding
+    centers = [x[rng.integers(len(x))]]
+    for _ in range(k - 1):
+        d = ((x[:, None, :] - np.array(centers)) ** 2).sum(axis=-1).min(axis=1)
+        if d.sum() == 0:
+            break
+        centers.append(x[rng.choice(len(x), p=d / d.sum())])
+    centers = np.array(centers)
+    counts = np.zeros(len(centers))
+
+    for _ in range(iterations):
+        sample = x[rng.choice(len(x), min(batch, len(x)), replace=False)]
+        nearest = ((sample[:, None, :] - centers) ** 2).sum(axis=-1).argmin(axis=1)
+        n = np.bincount(nearest, minlength=len(centers))
+        sums = np.zeros_like(centers)
+        np.add.at(sums, nearest, sample)
+        counts += n
+        moved = n > 0
+        centers[moved] += (sums[moved] - n[moved, None] * centers[moved]) / counts[moved, None]
+
+    nearest = ((x[:, None, :] - centers) ** 2).sum(axis=-1).argmin(axis=1)
+    share = np.bincount(nearest, minlength=len(centers)) / len(x)
+    centers, share = centers[share >= min_share], share[share >= min_share]
+
+    merged = []
+    for i in np.argsort(-share):
+        if all(((centers[i] - c) ** 2).sum() > merge_distance ** 2 for c in merged):
+            merged.append(centers[i])
+
+    return ClusterDetector(np.array(merged), min_saturation, min_value)
+
+
+def hs_histogram(patches, bins=(30, 32)):
+    """
+    Normalized hue-saturation histogram of (frame, mask) sample patches;
+    mask may be None to use the whole patch.
+    """
+    hist = None
+    for frame, mask in patches:
+        hsv = FrameContext.wrap(frame).hsv
+        hist = cv2.calcHist([hsv], [0, 1], mask, list(bins), [0, 180, 0, 256], hist, accumulate=hist is not None)
+
+    cv2.normalize(hist, hist, 0, 255, cv2.NORM_MINMAX)
+    return hist
+
+
+def backprojection_model(name, patches, version=1, bins=(30, 32), rebuild=False):
+    """
+    patches -> {color: [(frame, mask), ...]}
+    Histograms are built once per (name, version) and then reused, unless
+    rebuild is set.
+    """
+    key = (name, version)
+
+    if rebuild or key not in _models:
+        _models[key] = BackProjectionDetector(
+            name, {color: hs_histogram(p, bins) for color, p in patches.items() if p}, version
+        )
+
+    return _models[key]
+
+
+def get_model(name, version=1):
+    return _models.get((name, version))
+
+
+def as_detector(palette):
+    return palette if isinstance(palette, Detector) else ThresholdDetector(palette)
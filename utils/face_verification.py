@@ -1,19 +1,21 @@
 import cv2
 import numpy as np
 
+from utils.frame_context import FrameContext
+
 face_cascade = cv2.CascadeClassifier(
     cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
 )
 
 def extract_face(img):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+    img = FrameContext.wrap(img)
+    faces = face_cascade.detectMultiScale(img.gray, 1.3, 5)
 
     if len(faces) == 0:
         return None
 
     x, y, w, h = faces[0]
-    face = img[y:y+h, x:x+w]
+    face = img.bgr[y:y+h, x:x+w]
     face = cv2.resize(face, (200, 200))
     return face
 
@@ -0,0 +1,196 @@
+import cv2
+import numpy as np
+
+# Planar formats webcams usually deliver, and how to turn them into BGR.
+PLANAR = {
+    "yuv420p": cv2.COLOR_YUV2BGR_I420,
+    "yuvj420p": cv2.COLOR_YUV2BGR_I420,
+    "nv12": cv2.COLOR_YUV2BGR_NV12,
+}
+
+# BT.601 video-range Y, U, V -> B, G, R, as used by the I420/NV12 conversions.
+_YUV_TO_BGR = np.array([
+    [1.164, 2.017, 0.0, -1.164 * 16 - 2.017 * 128],
+    [1.164, -0.392, -0.813, -1.164 * 16 + (0.392 + 0.813) * 128],
+    [1.164, 0.0, 1.596, -1.164 * 16 - 1.596 * 128],
+])
+
+
+def _half_planar(raw, fmt, h, w):
+    """
+    Half-resolution BGR image built at the chroma planes' own resolution,
+    so only a quarter of the pixels go through a color conversion.
+    """
+    y = cv2.resize(raw[:h], (w // 2, h // 2), interpolation=cv2.INTER_AREA)
+    chroma = raw[h:].reshape(-1)
+    n = (h // 2) * (w // 2)
+
+    if fmt == "nv12":
+        u, v = chroma[0::2].reshape(h // 2, w // 2), chroma[1::2].reshape(h // 2, w // 2)
+    else:
+        u, v = chroma[:n].reshape(h // 2, w // 2), chroma[n:2 * n].reshape(h // 2, w // 2)
+
+    return cv2.transform(cv2.merge([y, u, v]), _YUV_TO_BGR)
+
+
+def _crop_planar(raw, fmt, h, w, y0, y1, x0, x1):
+    """
+    Crop of a 4:2:0 plane buffer, in the same layout; bounds must be even.
+    """
+    cy0, cy1 = y0 // 2, y1 // 2
+    chroma = raw[h:]
+
+    if fmt == "nv12":
+        return np.concatenate([raw[y0:y1, x0:x1], chroma[cy0:cy1, x0:x1]])
+
+    n = (h // 2) * (w // 2)
+    flat = chroma.reshape(-1)
+    u = flat[:n].reshape(h // 2, w // 2)[cy0:cy1, x0 // 2:x1 // 2]
+    v = flat[n:2 * n].reshape(h // 2, w // 2)[cy0:cy1, x0 // 2:x1 // 2]
+    uv = np.concatenate([u.reshape(-1), v.reshape(-1)]).reshape(cy1 - cy0, x1 - x0)
+    return np.concatenate([raw[y0:y1, x0:x1], uv])
+
+
+class FrameContext:
+    """
+    One frame plus the representations derived from it. gray, hsv, rgb and
+    downscaled copies are computed on first access and kept for the life of
+    the context, so every consumer of the same frame shares them.
+
+    raw is a BGR image (fmt "bgr24"), a grayscale image ("gray"), or the
+    (H * 3 / 2, W) plane buffer of a 4:2:0 frame ("yuv420p", "nv12").
+    """
+
+    __slots__ = ("raw", "format", "_bgr", "_gray", "_hsv", "_rgb", "_scaled")
+
+    def __init__(self, raw, fmt="bgr24"):
+        self.raw = raw
+        self.format = fmt
+        self._bgr = raw if fmt == "bgr24" else None
+        self._gray = raw if fmt == "gray" else None
+        self._hsv = None
+        self._rgb = None
+        self._scaled = None
+
+    @classmethod
+    def from_av(cls, frame):
+        """
+        Keeps 4:2:0 webcam frames in their native layout; anything else is
+        converted to bgr24.
+        """
+        fmt = frame.format.name
+        if fmt in PLANAR and frame.width % 2 == 0 and frame.height % 2 == 0:
+            return cls(frame.to_ndarray(), fmt)
+        return cls(frame.to_ndarray(format="bgr24"))
+
+    @classmethod
+    def wrap(cls, frame):
+        """
+        frame -> a FrameContext (returned as is) or a BGR / grayscale ndarray
+        """
+        if frame is None or isinstance(frame, cls):
+            return frame
+        return cls(frame, "gray" if frame.ndim == 2 else "bgr24")
+
+    @property
+    def size(self):
+        if self.format in PLANAR:
+            return self.raw.shape[0] * 2 // 3, self.raw.shape[1]
+        return self.raw.shape[:2]
+
+    @property
+    def shape(self):
+        return self.size + (3,)
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            if self.format in PLANAR:
+                self._bgr = cv2.cvtColor(self.raw, PLANAR[self.format])
+            else:
+                self._bgr = cv2.cvtColor(self.raw, cv2.COLOR_GRAY2BGR)
+        return self._bgr
+
+    @property
+    def gray(self):
+        """
+        For planar frames this is a view of the Y plane, no conversion.
+        """
+        if self._gray is None:
+            if self.format in PLANAR:
+                self._gray = self.raw[:self.size[0]]
+            else:
+                self._gray = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def hsv(self):
+        if self._hsv is None:
+            self._hsv = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2HSV)
+        return self._hsv
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    def scaled(self, factor):
+        """
+        Context for the frame shrunk by an integer factor (INTER_AREA). A
+        planar frame's half-size copy is built from its chroma planes.
+        """
+        if factor <= 1:
+            return self
+        if self._scaled is None:
+            self._scaled = {}
+
+        if factor not in self._scaled:
+            h, w = self.size
+            if factor == 2 and self.format in PLANAR and self._bgr is None:
+                small = _half_planar(self.raw, self.format, h, w)
+            elif factor % 2 == 0 and self.format in PLANAR and self._bgr is None:
+                small = self.scaled(2).scaled(factor // 2).bgr
+            else:
+                small = cv2.resize(
+                    self.bgr, (max(w // factor, 1), max(h // factor, 1)),
+                    interpolation=cv2.INTER_AREA,
+                )
+            self._scaled[factor] = FrameContext(small)
+
+        return self._scaled[factor]
+
+    def copy(self):
+        """
+        Independent BGR snapshot of the frame.
+        """
+        return FrameContext(self.bgr.copy())
+
+    def __getitem__(self, key):
+        """
+        ctx[y0:y1, x0:x1] -> context for a crop, sharing views of whatever
+        has already been computed for the full frame. A planar frame that
+        has not been converted yet stays planar when the bounds are even.
+        """
+        ys, xs = key if isinstance(key, tuple) else (key, slice(None))
+
+        if self.format in PLANAR and self._bgr is None:
+            h, w = self.size
+            y0, y1, ystep = ys.indices(h)
+            x0, x1, xstep = xs.indices(w)
+            if ystep == xstep == 1 and not (y0 | y1 | x0 | x1) & 1 and y1 > y0 and x1 > x0:
+                return FrameContext(_crop_planar(self.raw, self.format, h, w, y0, y1, x0, x1), self.format)
+
+        crop = FrameContext(self.bgr[ys, xs])
+
+        if self._hsv is not None:
+            crop._hsv = self._hsv[ys, xs]
+        if self._gray is not None:
+            crop._gray = self._gray[ys, xs]
+
+        if (ys.step or 1) != 1 or (xs.step or 1) != 1:
+            crop._bgr = np.ascontiguousarray(crop._bgr)
+            crop._hsv = None if crop._hsv is None else np.ascontiguousarray(crop._hsv)
+            crop._gray = None if crop._gray is None else np.ascontiguousarray(crop._gray)
+
+        return crop
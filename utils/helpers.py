@@ -1,14 +1,15 @@
 def calculate_accuracy(detected_order, target_order):
     """
     Accuracy is based STRICTLY on order comparison.
+    None in detected_order marks an empty position (counted as missing).
     """
 
     target_len = len(target_order)
-    detected_len = len(detected_order)
+    detected_len = len([c for c in detected_order if c is not None])
 
     correct = 0
 
-    for i in range(min(target_len, detected_len)):
+    for i in range(min(target_len, len(detected_order))):
         if detected_order[i] == target_order[i]:
             correct += 1
 
@@ -0,0 +1,80 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def row_order(centroids):
+    """
+    Indices of the centroids from left to right.
+    """
+    return np.argsort(centroids[:, 0], kind="stable")
+
+
+def spacing(centroids):
+    """
+    Median distance from each centroid to its nearest neighbour, the board
+    pitch used when blob sizes are not at hand.
+    """
+    if len(centroids) < 2:
+        return 0.0
+
+    d = ((centroids[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=-1)
+    np.fill_diagonal(d, np.inf)
+    return float(np.sqrt(np.median(d.min(axis=1))))
+
+
+def group_rows(centroids, gap=None):
+    """
+    Row index of each centroid, top row first. Centroids are sorted by y and
+    a new row starts wherever consecutive y values jump by more than gap
+    (half the spacing by default).
+    """
+    n = len(centroids)
+    if n == 0:
+        return np.empty(0, np.intp)
+    if gap is None:
+        gap = 0.5 * spacing(centroids)
+
+    order = np.argsort(centroids[:, 1], kind="stable")
+    rows = np.empty(n, np.intp)
+    rows[order] = np.concatenate([[0], np.cumsum(np.diff(centroids[order, 1]) > gap)])
+    return rows
+
+
+def grid_order(centroids, gap=None):
+    """
+    Row-major indices: rows top to bottom, left to right within a row.
+    """
+    return np.lexsort((centroids[:, 0], group_rows(centroids, gap)))
+
+
+def order_blobs(blobs, grid=False):
+    """
+    Blobs -> indices in reading order. Grid rows are split at half the
+    median blob height.
+    """
+    if not grid:
+        return row_order(blobs.centroid)
+
+    gap = 0.5 * float(np.median(blobs.bbox[:, 3])) if len(blobs.label) else 0.0
+    return grid_order(blobs.centroid, gap)
+
+
+def assign_to_targets(centroids, targets, max_distance=None):
+    """
+    Matches detections to target positions with the minimum total distance
+    (Hungarian algorithm). Returns, for each target, the index of its
+    detection or -1; pairs farther apart than max_distance stay unmatched.
+    """
+    match = np.full(len(targets), -1, np.intp)
+    if len(centroids) == 0 or len(targets) == 0:
+        return match
+
+    cost = np.sqrt(((targets[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=-1))
+    rows, cols = linear_sum_assignment(cost)
+
+    if max_distance is not None:
+        keep = cost[rows, cols] <= max_distance
+        rows, cols = rows[keep], cols[keep]
+
+    match[rows] = cols
+    return match
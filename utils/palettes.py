@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+PALETTE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "palettes.json"
+)
+
+# Compiled lookup tables keyed by (palette name, version, ranges digest). Each
+# table is 16 MB, so only the most recently used ones are kept.
+MAX_COMPILED = 8
+
+# Tables are indexed [v][s][h], with hue padded from 180 to 256, so a pixel's
+# index is its HSV bytes read as one little-endian uint32.
+LUT_SHAPE = (256, 256, 256)
+_compiled = OrderedDict()
+
+_registry = {"path": None, "mtime": None, "default": None, "palettes": {}}
+
+
+def ranges_digest(ranges):
+    """
+    Short sha1 digest of {color: [(lower, upper), ...]}, in color order.
+    """
+    canonical = json.dumps([
+        [color, [[list(lo), list(hi)] for lo, hi in bounds]] for color, bounds in ranges.items()
+    ])
+    return hashlib.sha1(canonical.encode()).hexdigest()[:8]
+
+
+def build_lut(ranges):
+    """
+    ranges -> {color: [(lower, upper), ...]} in OpenCV HSV (H: 0-179)
+    Returns lut where lut[v, s, h] is the 1-based index of the color in
+    ranges, or 0 for background. On overlap the first color wins.
+    """
+    names = list(ranges)
+    lut = np.zeros(LUT_SHAPE, np.uint8)
+
+    for label in range(len(names), 0, -1):
+        for lower, upper in ranges[names[label - 1]]:
+            (h0, s0, v0), (h1, s1, v1) = lower, upper
+            lut[v0:v1 + 1, s0:s1 + 1, h0:h1 + 1] = label
+
+    return lut
+
+
+def classify(hsv, lut):
+    """
+    Labels every pixel of an HSV image in one pass through the lookup table.
+    The index is built by a single merge with a zero channel, whose bytes
+    read as uint32 are h | s << 8 | v << 16.
+    """
+    zeros = np.zeros(hsv.shape[:2], np.uint8)
+    idx = cv2.merge([hsv, zeros]).view(np.uint32)[..., 0]
+    return lut.reshape(-1).take(idx)
+
+
+class Palette:
+    def __init__(self, name, ranges, version=1, lut=None):
+        self.name = name
+        self.version = version
+        self.ranges = OrderedDict(
+            (color, [(tuple(lo), tuple(hi)) for lo, hi in bounds])
+            for color, bounds in ranges.items()
+        )
+        self.colors = list(self.ranges)
+        self.digest = ranges_digest(self.ranges)
+
+        if lut is not None:
+            _compiled[self.key] = lut
+
+    @property
+    def key(self):
+        return (self.name, self.version, self.digest)
+
+    @property
+    def lut(self):
+        """
+        HSV -> label table, compiled on first use and shared by every
+        Palette with the same name, version and ranges.
+        """
+        lut = _compiled.get(self.key)
+
+        if lut is None:
+            lut = build_lut(self.ranges)
+            _compiled[self.key] = lut
+            while len(_compiled) > MAX_COMPILED:
+                _compiled.popitem(last=False)
+        else:
+            _compiled.move_to_end(self.key)
+
+        return lut
+
+
+def load_palettes(path=PALETTE_FILE):
+    """
+    Reads the palette config. The file is only parsed again when it changes
+    on disk; a palette whose ranges were edited gets a new compiled table
+    whether or not its version was bumped.
+    """
+    mtime = os.path.getmtime(path)
+
+    if _registry["path"] == path and _registry["mtime"] == mtime:
+        return _registry["palettes"]
+
+    with open(path) as f:
+        config = json.load(f, object_pairs_hook=OrderedDict)
+
+    palettes = OrderedDict(
+        (name, Palette(name, spec["colors"], spec.get("version", 1)))
+        for name, spec in config["palettes"].items()
+    )
+
+    _registry.update(
+        path=path,
+        mtime=mtime,
+        default=config.get("default", next(iter(palettes))),
+        palettes=palettes,
+    )
+    return palettes
+
+
+def palette_names():
+    return list(load_palettes())
+
+
+def default_palette_name():
+    load_palettes()
+    return _registry["default"]
+
+
+def get_palette(name=None):
+    palettes = load_palettes()
+    return palettes[name or _registry["default"]]
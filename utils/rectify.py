@@ -0,0 +1,104 @@
+import re
+
+import cv2
+import numpy as np
+
+from utils.frame_context import FrameContext
+
+# Width of the rectified play area; the height follows the quad's aspect.
+CANONICAL_WIDTH = 640
+
+# Corner markers are 4x4 ArUco tags with ids 0-3, one per play-area corner.
+MARKER_DICT = cv2.aruco.DICT_4X4_50
+MARKER_IDS = (0, 1, 2, 3)
+
+
+def order_quad(points):
+    """
+    Four points -> float32 (4, 2) in top-left, top-right, bottom-right,
+    bottom-left order.
+    """
+    pts = np.asarray(points, np.float32).reshape(4, 2)
+    s = pts.sum(axis=1)
+    d = pts[:, 1] - pts[:, 0]
+    return pts[[np.argmin(s), np.argmin(d), np.argmax(s), np.argmax(d)]]
+
+
+def find_markers(frame, ids=MARKER_IDS):
+    """
+    Play-area quad spanned by the centers of the corner markers, or None
+    unless all of them are visible.
+    """
+    detector = cv2.aruco.ArucoDetector(cv2.aruco.getPredefinedDictionary(MARKER_DICT))
+    corners, found, _ = detector.detectMarkers(FrameContext.wrap(frame).gray)
+    if found is None:
+        return None
+
+    centers = {int(i): c.reshape(4, 2).mean(axis=0) for i, c in zip(found.ravel(), corners)}
+    if any(i not in centers for i in ids):
+        return None
+    return order_quad([centers[i] for i in ids])
+
+
+def parse_quad(text):
+    """
+    "x,y x,y x,y x,y" (any separators, any corner order) -> quad, or None.
+    """
+    numbers = re.findall(r"-?\d+(?:\.\d+)?", text or "")
+    if len(numbers) != 8:
+        return None
+    return order_quad(np.array(numbers, np.float32))
+
+
+def parse_roi(text):
+    """
+    "x0,y0,x1,y1" -> play-area rectangle with even bounds (so planar frames
+    crop without conversion), or None.
+    """
+    numbers = [int(float(n)) for n in re.findall(r"-?\d+(?:\.\d+)?", text or "")]
+    if len(numbers) != 4:
+        return None
+
+    x0, x1 = sorted(numbers[0::2])
+    y0, y1 = sorted(numbers[1::2])
+    x0, y0, x1, y1 = (max(v, 0) & ~1 for v in (x0, y0, x1, y1))
+    return (x0, y0, x1, y1) if x1 > x0 and y1 > y0 else None
+
+
+def clamp_roi(roi, size):
+    """
+    Play-area rectangle clipped to a frame of size (h, w), keeping even
+    bounds, or None if nothing of it is inside the frame.
+    """
+    if roi is None:
+        return None
+
+    h, w = size
+    x0, y0, x1, y1 = roi
+    x0, x1 = min(x0, w & ~1), min(x1, w & ~1)
+    y0, y1 = min(y0, h & ~1), min(y1, h & ~1)
+    return (x0, y0, x1, y1) if x1 > x0 and y1 > y0 else None
+
+
+def homography(quad, width=CANONICAL_WIDTH):
+    """
+    Maps quad onto an upright rectangle width pixels wide with the quad's
+    aspect. Returns the warp (H, (width, height)).
+    """
+    tl, tr, br, bl = order_quad(quad)
+    across = np.linalg.norm(tr - tl) + np.linalg.norm(br - bl)
+    down = np.linalg.norm(bl - tl) + np.linalg.norm(br - tr)
+    height = max(int(round(width * down / max(across, 1.0))), 1)
+
+    target = np.float32([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]])
+    return cv2.getPerspectiveTransform(np.float32([tl, tr, br, bl]), target), (width, height)
+
+
+def rectify(frame, warp):
+    """
+    Context for the play area of frame warped by warp = (H, size). Only the
+    output pixels are computed, so the cost follows size, not the camera
+    resolution.
+    """
+    H, size = warp
+    return FrameContext(cv2.warpPerspective(FrameContext.wrap(frame).bgr, H, size, flags=cv2.INTER_LINEAR))
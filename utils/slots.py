@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+
+from utils.color_detection import label_image
+from utils.frame_context import FrameContext
+from utils.ordering import order_blobs
+from utils.palettes import get_palette
+
+
+def even_slots(box, n, gap=0.1):
+    """
+    n equal slots in a row inside box (x0, y0, x1, y1), with a fraction gap
+    of each slot's width left empty between neighbours.
+    Returns an (n, 4) int32 array of (x0, y0, x1, y1).
+    """
+    x0, y0, x1, y1 = box
+    step = (x1 - x0) / n
+    left = x0 + step * np.arange(n) + step * gap / 2
+    right = left + step * (1 - gap)
+
+    return np.stack([
+        left, np.full(n, y0), right, np.full(n, y1)
+    ], axis=1).round().astype(np.int32)
+
+
+def slots_from_blobs(blobs, pad=0.25, grid=False):
+    """
+    One slot per blob in reading order (left to right, or row by row for a
+    grid), each blob's bbox grown by pad of its size.
+    """
+    order = order_blobs(blobs, grid)
+    x, y, w, h = blobs.bbox[order].T
+    px, py = (w * pad).astype(np.int32), (h * pad).astype(np.int32)
+    return np.stack([x - px, y - py, x + w + px, y + h + py], axis=1).clip(0).astype(np.int32)
+
+
+def color_integrals(labels, n_labels):
+    """
+    (n_labels, H + 1, W + 1) integral images, one per color, of the pixels
+    carrying that label.
+    """
+    ii = np.empty((n_labels, labels.shape[0] + 1, labels.shape[1] + 1), np.int32)
+    for label in range(1, n_labels + 1):
+        ii[label - 1] = cv2.integral(np.equal(labels, label).view(np.uint8), sdepth=cv2.CV_32S)
+    return ii
+
+
+def slot_labels(integrals, slots, min_fill=0.2):
+    """
+    Dominant color of every slot from four integral-image lookups per color.
+    Slots where no color covers min_fill of the area get label 0.
+    Returns (labels, fill).
+    """
+    h, w = integrals.shape[1] - 1, integrals.shape[2] - 1
+    x0, y0, x1, y1 = slots.T
+    x0, x1 = x0.clip(0, w), x1.clip(0, w)
+    y0, y1 = y0.clip(0, h), y1.clip(0, h)
+
+    counts = (
+        integrals[:, y1, x1] - integrals[:, y0, x1] - integrals[:, y1, x0] + integrals[:, y0, x0]
+    )
+    best = counts.argmax(axis=0)
+    area = np.maximum((x1 - x0) * (y1 - y0), 1)
+    fill = counts[best, np.arange(len(slots))] / area
+
+    return np.where(fill >= min_fill, best + 1, 0), fill
+
+
+def score_slots(frame, slots, palette=None, mask=None, min_fill=0.2, labels=None):
+    """
+    Color name (or None) in each slot, left to right. Only the part of the
+    frame covered by the slots is classified, unless a full-frame label
+    image of it is passed in labels. Slots outside the frame are empty.
+    """
+    palette = palette or get_palette()
+    frame = FrameContext.wrap(frame)
+    slots = np.asarray(slots, np.int32)
+    if not len(slots):
+        return []
+
+    h, w = frame.shape[:2]
+    x0, y0 = max(int(slots[:, 0].min()), 0), max(int(slots[:, 1].min()), 0)
+    x1, y1 = min(int(slots[:, 2].max()), w), min(int(slots[:, 3].max()), h)
+    if x1 <= x0 or y1 <= y0:
+        return [None] * len(slots)
+
+    if labels is not None:
+        labels = labels[y0:y1, x0:x1]
+    else:
+        labels = label_image(
+            frame[y0:y1, x0:x1], palette, None if mask is None else mask[y0:y1, x0:x1]
+        )
+    found, _ = slot_labels(
+        color_integrals(labels, len(palette.colors)), slots - (x0, y0, x0, y0), min_fill
+    )
+
+    return [palette.colors[l - 1] if l else None for l in found.tolist()]
@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+
+from utils.frame_context import FrameContext
+
+
+def gray_world_gains(frame, mask=None, limits=(0.5, 2.0)):
+    """
+    Per-channel (B, G, R) gains that make the average of frame (or of the
+    mask region, e.g. a gray reference card) neutral gray.
+    """
+    b, g, r, _ = cv2.mean(FrameContext.wrap(frame).bgr, mask)
+    means = np.maximum([b, g, r], 1.0)
+    return np.clip(means.mean() / means, *limits)
+
+
+def balance_lut(gains):
+    """
+    (1, 256, 3) uint8 table scaling each channel by its gain, for cv2.LUT.
+    """
+    levels = np.arange(256, dtype=np.float32)[:, None] * np.asarray(gains, np.float32)
+    return np.clip(np.round(levels), 0, 255).astype(np.uint8)[None]
+
+
+def white_balance(frame, lut):
+    """
+    Context for frame with lut applied to its BGR pixels in one pass.
+    """
+    return FrameContext(cv2.LUT(FrameContext.wrap(frame).bgr, lut))
@@ -0,0 +1,103 @@
+import numpy as np
+
+from utils.color_detection import MIN_AREA, blob_near, detect_blobs
+from utils.frame_context import FrameContext
+from utils.palettes import get_palette
+
+
+class Track:
+    __slots__ = ("id", "label", "bbox", "centroid", "area", "lost")
+
+    def __init__(self, id, label, bbox, centroid, area):
+        self.id = id
+        self.label = label
+        self.bbox = bbox
+        self.centroid = centroid
+        self.area = area
+        self.lost = 0
+
+
+class ColorTracker:
+    """
+    Keeps block identities between frames. Each frame only a small window
+    around every known block is classified; a full (pyramid) detection runs
+    when a block has been lost for max_lost frames, or every
+    redetect_every frames to pick up newly placed blocks.
+    """
+
+    def __init__(self, palette=None, min_area=MIN_AREA, search=0.5,
+                 max_lost=3, redetect_every=30, downscale=4):
+        self.palette = palette
+        self.min_area = min_area
+        self.search = search
+        self.max_lost = max_lost
+        self.redetect_every = redetect_every
+        self.downscale = downscale
+
+        self.tracks = []
+        self.next_id = 1
+        self.since_full = redetect_every
+        self.palette_key = None
+
+    def reset(self):
+        self.tracks = []
+        self.since_full = self.redetect_every
+
+    def update(self, frame):
+        frame = FrameContext.wrap(frame)
+        palette = self.palette or get_palette()
+
+        if palette.key != self.palette_key:
+            self.reset()
+            self.palette_key = palette.key
+
+        if self.since_full >= self.redetect_every:
+            self._full(frame, palette)
+            return self.tracks
+
+        self.since_full += 1
+        h, w = frame.shape[:2]
+
+        for t in self.tracks:
+            x, y, bw, bh = t.bbox
+            pad = int(self.search * max(bw, bh)) + 2
+            window = (max(x - pad, 0), max(y - pad, 0), min(x + bw + pad, w), min(y + bh + pad, h))
+            blob = blob_near(frame, palette, t.label, window, t.centroid, min_area=self.min_area)
+
+            if blob is None:
+                t.lost += 1
+                continue
+
+            t.bbox = tuple(blob.bbox[0].tolist())
+            t.centroid = tuple(blob.centroid[0].tolist())
+            t.area = int(blob.area[0])
+            t.lost = 0
+
+        if any(t.lost >= self.max_lost for t in self.tracks):
+            self._full(frame, palette)
+
+        return self.tracks
+
+    def _full(self, frame, palette):
+        blobs = detect_blobs(frame, palette, self.min_area, downscale=self.downscale)
+        old = self.tracks
+        tracks = []
+
+        # keep the id of the nearest previous track of the same color
+        for label, bbox, centroid, area in zip(blobs.label, blobs.bbox, blobs.centroid, blobs.area):
+            same = [t for t in old if t.label == label]
+            if same:
+                d = [(t.centroid[0] - centroid[0]) ** 2 + (t.centroid[1] - centroid[1]) ** 2 for t in same]
+                prev = same[int(np.argmin(d))]
+                old.remove(prev)
+                track_id = prev.id
+            else:
+                track_id = self.next_id
+                self.next_id += 1
+
+            tracks.append(Track(
+                track_id, int(label), tuple(bbox.tolist()), tuple(centroid.tolist()), int(area)
+            ))
+
+        self.tracks = tracks
+        self.since_full = 0
@@ -1,15 +1,65 @@
 import av
 import cv2
+import numpy as np
 import time
 from streamlit_webrtc import VideoProcessorBase
 
+from analysis.segmentation import Segmenter
+from utils.color_detection import MIN_AREA
+from utils.slots import score_slots
+from utils.frame_context import FrameContext
+from utils.rectify import clamp_roi
+from video.tracker import ColorTracker
+
 
 class VideoProcessor(VideoProcessorBase):
     def __init__(self):
-        self.frame = None
+        # latest frame, kept in the camera's native layout
+        self.latest = None
         self.prev_gray = None
         self.last_motion_time = time.time()
         self.bg_saved = False
+        self.segmenter = Segmenter()
+
+        # running average of the scene, updated every bg_every frames once
+        # nothing has moved for bg_quiet seconds, and only where the frame
+        # still looks like background, so placed blocks are not absorbed;
+        # if more than bg_reseed of the frame differs the lighting itself
+        # changed, and the model restarts from the current frame. Pixels
+        # that have differed without moving for bg_heal_after updates (about
+        # 40 s of stillness at 30 fps) fade in at the much lower
+        # bg_heal_rate, so something that was on the table when the model
+        # was seeded and has since left is healed, while recent or moving
+        # foreground stays frozen out
+        self.bg_model = None
+        self.background = None
+        self.bg_rate = 0.05
+        self.bg_every = 10
+        self.bg_quiet = 2.0
+        self.bg_reseed = 0.5
+        self.bg_heal_after = 120
+        self.bg_heal_rate = 0.005
+        self.bg_age = None
+        self.bg_last = None
+        self.frame_count = 0
+
+        # tracking and slot scoring run on the half-resolution chroma image,
+        # so track coordinates are half of the full-frame ones; tracking is
+        # off until the live view asks for it
+        self.palette = None
+        self.tracking = False
+        self.show_tracks = False
+        self.tracker = ColorTracker(min_area=MIN_AREA // 4, downscale=2)
+
+        # slots are scored and drawn live only while show_slots is set
+        self.slots = None
+        self.slot_colors = []
+        self.show_slots = False
+
+        # play-area rectangle (x0, y0, x1, y1); motion, tracking and slots
+        # only look inside it, in its own coordinates
+        self.roi = None
+        self.show_roi = False
 
        
         self.reference_face = None
@@ -21,14 +71,8 @@ class VideoProcessor(VideoProcessorBase):
         if self.reference_face is None or self.background_face is None:
             return True
 
-        ref = self.reference_face
-        bg = self.background_face
-
-       
-        if len(ref.shape) == 3:
-            ref = cv2.cvtColor(ref, cv2.COLOR_BGR2GRAY)
-        if len(bg.shape) == 3:
-            bg = cv2.cvtColor(bg, cv2.COLOR_BGR2GRAY)
+        ref = FrameContext.wrap(self.reference_face).gray
+        bg = FrameContext.wrap(self.background_face).gray
 
         ref = cv2.resize(ref, (200, 200))
         bg = cv2.resize(bg, (200, 200))
@@ -38,53 +82,122 @@ class VideoProcessor(VideoProcessorBase):
 
         return error < 2000
 
+    @property
+    def frame(self):
+        """
+        Latest frame as BGR, converted only when someone asks for it.
+        """
+        latest = self.latest
+        return None if latest is None else latest.bgr
+
+    def reset_background(self, frame):
+        """
+        Restarts the background model from frame.
+        """
+        frame = FrameContext.wrap(frame)
+        bgr = frame.bgr
+        self.bg_model = bgr.astype(np.float32)
+        self.background = FrameContext(bgr.copy())
+        self.bg_age = np.zeros(bgr.shape[:2], np.uint8)
+        self.bg_last = frame.gray.copy()
+
+    def update_background(self, frame):
+        bgr = frame.bgr
+        if self.bg_model is None or self.bg_model.shape != bgr.shape:
+            self.reset_background(frame)
+            return
+
+        changed = self.segmenter.foreground(self.background, bgr)
+        if cv2.countNonZero(changed) > self.bg_reseed * changed.size:
+            self.reset_background(frame)
+            return
+
+        size = bgr.shape[:2]
+        still = self.segmenter.buffer("still", size)
+        cv2.bitwise_not(changed, dst=still)
+        cv2.accumulateWeighted(bgr, self.bg_model, self.bg_rate, mask=still)
+
+        # age of the foreground that has stayed put since the last update
+        gray = frame.gray
+        settled = self.segmenter.buffer("settled", size)
+        cv2.absdiff(gray, self.bg_last, dst=settled)
+        cv2.threshold(settled, self.segmenter.motion_threshold, 255, cv2.THRESH_BINARY_INV, dst=settled)
+        cv2.bitwise_and(settled, changed, dst=settled)
+        cv2.add(self.bg_age, 1, dst=self.bg_age)
+        cv2.bitwise_and(self.bg_age, settled, dst=self.bg_age)
+        np.copyto(self.bg_last, gray)
+
+        heal = self.segmenter.buffer("heal", size)
+        cv2.compare(self.bg_age, self.bg_heal_after, cv2.CMP_GE, dst=heal)
+        cv2.accumulateWeighted(bgr, self.bg_model, self.bg_heal_rate, mask=heal)
+        self.background = FrameContext(cv2.convertScaleAbs(self.bg_model))
+
    
     def recv(self, frame):
-        img = frame.to_ndarray(format="bgr24")
-        self.frame = img.copy()
+        current = FrameContext.from_av(frame)
+        self.latest = current
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        roi = clamp_roi(self.roi, current.size)
+        x0, y0 = (0, 0) if roi is None else roi[:2]
+        view = current if roi is None else current[y0:roi[3], x0:roi[2]]
+        gray = view.gray
+        notes = []
+        small = view.scaled(2)
 
-        if not self.bg_saved:
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
+        slots = self.slots if self.show_slots else None
+        if slots is not None:
+            self.slot_colors = score_slots(small, slots // 2, self.palette)
 
-        if self.prev_gray is None:
-            self.prev_gray = gray
-            return av.VideoFrame.from_ndarray(img, format="bgr24")
+        if self.tracking:
+            self.tracker.palette = self.palette
+            self.tracker.update(small)
 
-        
-        diff = cv2.absdiff(self.prev_gray, gray)
-        _, thresh = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
-        motion_pixels = cv2.countNonZero(thresh)
+        if self.prev_gray is not None and self.prev_gray.shape != gray.shape:
+            self.prev_gray = None
 
-        if motion_pixels > 2000:
+        if self.prev_gray is not None and self.segmenter.motion(self.prev_gray, gray) > 2000:
             self.last_motion_time = time.time()
 
-        
-        if time.time() - self.last_motion_time > 3:
-            cv2.putText(
-                img,
-                "⚠️ PLACE THE COLOR!",
-                (50, 80),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (0, 0, 255),
-                3
-            )
+        self.frame_count += 1
+        if self.frame_count % self.bg_every == 0 and time.time() - self.last_motion_time > self.bg_quiet:
+            self.update_background(current)
 
-       
-        self.identity_matched = self.compare_faces()
-
-        if not self.identity_matched:
-            cv2.putText(
-                img,
-                "🚫 IDENTITY MISMATCH",
-                (50, 140),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (0, 0, 255),
-                3
-            )
+        if self.bg_saved and self.prev_gray is not None:
+            if time.time() - self.last_motion_time > 3:
+                notes.append(("⚠️ PLACE THE COLOR!", (50, 80)))
+
+            self.identity_matched = self.compare_faces()
+
+            if not self.identity_matched:
+                notes.append(("🚫 IDENTITY MISMATCH", (50, 140)))
 
         self.prev_gray = gray
-        return av.VideoFrame.from_ndarray(img, format="bgr24")
\ No newline at end of file
+
+        tracks = self.tracker.tracks if self.tracking and self.show_tracks else []
+        outline = roi is not None and self.show_roi
+        if not notes and not tracks and not outline and slots is None:
+            return frame
+
+        img = current.bgr.copy()
+
+        if outline:
+            cv2.rectangle(img, (x0, y0), (roi[2], roi[3]), (0, 255, 255), 2)
+
+        if slots is not None:
+            for (sx0, sy0, sx1, sy1), color in zip(slots.tolist(), self.slot_colors):
+                cv2.rectangle(img, (sx0 + x0, sy0 + y0), (sx1 + x0, sy1 + y0), (255, 255, 255), 2)
+                cv2.putText(img, color or "-", (sx0 + x0 + 4, sy1 + y0 - 6),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+
+        colors = [] if self.palette is None else self.palette.colors
+        for t in tracks:
+            x, y = int(t.centroid[0] * 2) + x0, int(t.centroid[1] * 2) + y0
+            cv2.circle(img, (x, y), 6, (255, 255, 255), -1)
+            if t.label <= len(colors):
+                cv2.putText(img, colors[t.label - 1], (x + 10, y - 10),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+
+        for text, org in notes:
+            cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 3)
+
+        return av.VideoFrame.from_ndarray(img, format="bgr24")